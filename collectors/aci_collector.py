@@ -6,10 +6,25 @@ import json
 import datetime
 import urllib3
 import yaml
+import ssl
+import time
 import logging
+import threading
+import concurrent.futures
+from collector_utils import collect_concurrently
 from logging import StreamHandler
 from pprint import pprint
 from getpass import getpass
+# websocket-client is only required by the endpoint subscription mode (aci_endpoint_subscription)
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+# Configuration parameters added to every document by basebeat when POSTing.
+envelope_fields = ['environment', 'region_name']
+# collect_data() adds the scheduled operations it completed to config_data['ops_completed'].
+reports_ops_completed = True
 
 class Apic():
     # APIC login, connect and disconnect functions
@@ -30,8 +45,24 @@ class Apic():
         self.site = ''
         self.session = requests.Session()
         self.refresh_time_epoch = 0
+        # Serialises re-login when the session is shared by concurrent queries
+        self.lock = threading.Lock()
+        # MOs fetched by aci_get_mo(), an Apic instance lives for one collection cycle
+        self.mo_cache = {}
+        # Class queries are paged when page_size is set, parallel_pages are fetched at a time
+        self.page_size = None
+        self.parallel_pages = 1
+        # Requests in flight to the APIC, shared by every thread using this instance
+        self.max_inflight = 1
         if kwargs:
             self.fabrics = kwargs['fabrics']
+            self.page_size = kwargs.get('page_size')
+            self.parallel_pages = kwargs.get('parallel_pages', 1)
+            self.max_inflight = kwargs.get('max_inflight', 1)
+        self.inflight = threading.BoundedSemaphore(self.max_inflight)
+        # Connections are kept for re-use, never more than the requests in flight
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=self.max_inflight,
+                                                                     pool_block=True))
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         urllib3.disable_warnings(urllib3.exceptions.InsecurePlatformWarning)
         urllib3.disable_warnings(urllib3.exceptions.SNIMissingWarning)
@@ -97,7 +128,7 @@ class Apic():
             uri = "https://{0}/api/aaaLogin.json".format(apic_address)
             payload = {'aaaUser': {'attributes': {'name': apic_user, 'pwd': apic_password}}}
             try:
-                response = self.session.post(uri, data=json.dumps(payload), headers=self.headers, verify=False,
+                response = self.http_post(uri, data=json.dumps(payload), headers=self.headers, verify=False,
                                              timeout=10)
                 if response.status_code == 200:
                     self.cookie = {'APIC-cookie': response.cookies['APIC-cookie']}
@@ -122,7 +153,21 @@ class Apic():
         except:
             pass
 
+    def http_get(self, uri, **kwargs):
+        """ GET from the APIC, waiting while max_inflight requests are already in flight """
+        with self.inflight:
+            return self.session.get(uri, **kwargs)
+
+    def http_post(self, uri, **kwargs):
+        """ POST to the APIC, waiting while max_inflight requests are already in flight """
+        with self.inflight:
+            return self.session.post(uri, **kwargs)
+
     def refresh_connection(self, timeout=90):
+        with self.lock:
+            return self._refresh_connection(timeout)
+
+    def _refresh_connection(self, timeout):
         error_msgs = []
         try:
             current_time_epoch = int(datetime.datetime.now().strftime('%s'))
@@ -133,7 +178,7 @@ class Apic():
                 apic_address = self.apic_address
                 uri = "https://{0}/api/aaaLogin.json".format(apic_address)
                 payload = {'aaaUser': {'attributes': {'name': apic_user, 'pwd': apic_password}}}
-                response = self.session.post(uri, data=json.dumps(payload), headers=self.headers, verify=False)
+                response = self.http_post(uri, data=json.dumps(payload), headers=self.headers, verify=False)
                 if response.status_code == 200:
                     self.cookie = {'APIC-cookie': response.cookies['APIC-cookie']}
                     self.apic_address = apic_address
@@ -160,6 +205,16 @@ class Apic():
         result = self.refresh_connection()
         if result['rc'] == 1:
             return {'rc': 1, 'error': result['error']}
+        if self.page_size:
+            # Assemble the pages, keeps each response below APIC size limits
+            try:
+                data = list(self.aci_iter_class(class_name, sub_classes))
+            except Exception as error:
+                return {'rc': 1, 'error': [str(error)]}
+            if data:
+                return {'rc': 0, 'data': data}
+            else:
+                return {'rc': 1, 'data': []}
         if sub_classes:
             class_filter = ','.join(sub_classes)
             options = '?rsp-subtree=children&rsp-subtree-class={}'.format(class_filter)
@@ -169,7 +224,7 @@ class Apic():
             uri = "https://{0}/api/class/{1}.json".format(self.apic_address, class_name)
             if options:
                 uri += options
-            response = self.session.get(uri, headers=self.headers, cookies=self.cookie, verify=False).json()
+            response = self.http_get(uri, headers=self.headers, cookies=self.cookie, verify=False).json()
             if response['imdata']:
                 return {'rc': 0, 'data': response['imdata']}
             else:
@@ -177,7 +232,123 @@ class Apic():
         except Exception as error:
             return {'rc': 1, 'error': [str(error)]}
 
+    def aci_get_page_data(self, uri, page):
+        """ Return the response data of one page of a class query """
+        result = self.refresh_connection()
+        if result['rc'] == 1:
+            raise RuntimeError('; '.join(result['error']))
+        page_uri = '{}&page={}&page-size={}'.format(uri, page, self.page_size)
+        response = self.http_get(page_uri, headers=self.headers, cookies=self.cookie, verify=False)
+        if response.status_code != 200:
+            raise RuntimeError('Class query {} failed, status code {}'.format(page_uri, response.status_code))
+        return response.json()
+
+    def aci_get_page(self, uri, page):
+        """ Return (imdata, totalCount) of one page of a class query """
+        response_data = self.aci_get_page_data(uri, page)
+        return response_data['imdata'], int(response_data.get('totalCount', 0))
+
+    def aci_iter_class(self, class_name, sub_classes=[], prop_include=None):
+        """ Yield the objects of a class one at a time.
+
+        When page_size is set the class is retrieved page by page (ordered by DN so pages
+        are stable), fetching up to parallel_pages pages concurrently, so only a few pages
+        are held in memory. Page requests count towards max_inflight like every other APIC
+        request. Errors are raised as the caller has no result dictionary.
+        """
+        options = ['rsp-subtree=children&rsp-subtree-class={}'.format(','.join(sub_classes))] if sub_classes else []
+        if prop_include:
+            options.append('rsp-prop-include={}'.format(prop_include))
+        uri = "https://{0}/api/class/{1}.json".format(self.apic_address, class_name)
+        if not self.page_size:
+            result = self.refresh_connection()
+            if result['rc'] == 1:
+                raise RuntimeError('; '.join(result['error']))
+            if options:
+                uri += '?' + '&'.join(options)
+            response = self.http_get(uri, headers=self.headers, cookies=self.cookie, verify=False).json()
+            for item in response['imdata']:
+                yield item
+            return
+        options.append('order-by={}.dn'.format(class_name))
+        uri += '?' + '&'.join(options)
+        imdata, total_count = self.aci_get_page(uri, 0)
+        for item in imdata:
+            yield item
+        pages = -(-total_count // self.page_size)
+        if pages <= 1:
+            return
+        # More pages than requests allowed in flight would only wait on the semaphore.
+        parallel_pages = min(self.parallel_pages, self.max_inflight)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=parallel_pages)
+        try:
+            next_page = 1
+            window = []
+            while next_page < pages or window:
+                while next_page < pages and len(window) < parallel_pages:
+                    window.append(executor.submit(self.aci_get_page, uri, next_page))
+                    next_page += 1
+                imdata, _ = window.pop(0).result()
+                for item in imdata:
+                    yield item
+        finally:
+            executor.shutdown(wait=False)
+
+    def aci_subscribe_class(self, class_name, sub_classes=[], prop_include=None):
+        """ Class query with subscription=yes, events for the class are sent to the APIC WebSocket.
+
+        When page_size is set the snapshot is retrieved page by page, as in aci_iter_class.
+        Each page query opens its own subscription, all of their IDs are returned.
+        """
+        result = self.refresh_connection()
+        if result['rc'] == 1:
+            return {'rc': 1, 'error': result['error']}
+        options = ['subscription=yes']
+        if sub_classes:
+            options.append('rsp-subtree=children&rsp-subtree-class={}'.format(','.join(sub_classes)))
+        if prop_include:
+            options.append('rsp-prop-include={}'.format(prop_include))
+        try:
+            uri = "https://{0}/api/class/{1}.json".format(self.apic_address, class_name)
+            if not self.page_size:
+                uri += '?' + '&'.join(options)
+                response = self.http_get(uri, headers=self.headers, cookies=self.cookie, verify=False).json()
+                return {'rc': 0, 'data': response['imdata'], 'subscription_ids': [response['subscriptionId']]}
+            options.append('order-by={}.dn'.format(class_name))
+            uri += '?' + '&'.join(options)
+            data = []
+            subscription_ids = []
+            page = 0
+            pages = 1
+            while page < pages:
+                response_data = self.aci_get_page_data(uri, page)
+                data.extend(response_data['imdata'])
+                subscription_ids.append(response_data['subscriptionId'])
+                pages = -(-int(response_data.get('totalCount', 0)) // self.page_size)
+                page += 1
+            return {'rc': 0, 'data': data, 'subscription_ids': subscription_ids}
+        except Exception as error:
+            return {'rc': 1, 'error': [str(error)]}
+
+    def aci_class_signature(self, class_name):
+        """ Return (count, latest modTs) of a class from a single object query """
+        result = self.refresh_connection()
+        if result['rc'] == 1:
+            raise RuntimeError('; '.join(result['error']))
+        uri = "https://{0}/api/class/{1}.json?order-by={1}.modTs|desc&page=0&page-size=1".format(
+            self.apic_address, class_name)
+        response = self.http_get(uri, headers=self.headers, cookies=self.cookie, verify=False)
+        if response.status_code != 200:
+            raise RuntimeError('Class query {} failed, status code {}'.format(uri, response.status_code))
+        response_data = response.json()
+        latest = None
+        if response_data['imdata']:
+            latest = response_data['imdata'][0][class_name]['attributes'].get('modTs')
+        return int(response_data.get('totalCount', 0)), latest
+
     def aci_get_mo(self, dn, subtree_class):
+        if (dn, subtree_class) in self.mo_cache:
+            return self.mo_cache[(dn, subtree_class)]
         # Refreshing connection to ACI
         result = self.refresh_connection()
         if result['rc'] == 1:
@@ -187,11 +358,13 @@ class Apic():
             subtree = 'children'
             options = '?rsp-subtree={}&rsp-subtree-class={}'.format(subtree, subtree_class)
             uri += options
-            response = self.session.get(uri, headers=self.headers, cookies=self.cookie, verify=False).json()
+            response = self.http_get(uri, headers=self.headers, cookies=self.cookie, verify=False).json()
             if response['imdata']:
-                return {'rc': 0, 'data': response['imdata']}
+                result = {'rc': 0, 'data': response['imdata']}
             else:
-                return {'rc': 1, 'data': []}
+                result = {'rc': 1, 'data': []}
+            self.mo_cache[(dn, subtree_class)] = result
+            return result
         except Exception as error:
             return {'rc': 1, 'error': [str(error)]}
 
@@ -227,61 +400,108 @@ class Apic():
         except Exception as error:
             return {'rc': 1, 'error': [str(error)]}
 
-    def aci_get_ports_capacity(self):
+    def aci_get_node_count(self, class_name, node_dn):
+        """ Count of class objects on one node, counted by the APIC (rsp-subtree-include=count) """
+        result = self.refresh_connection()
+        if result['rc'] == 1:
+            raise RuntimeError('; '.join(result['error']))
+        uri = "https://{0}/api/node/class/{1}/{2}.json?rsp-subtree-include=count".format(self.apic_address,
+                                                                                       node_dn, class_name)
+        response = self.http_get(uri, headers=self.headers, cookies=self.cookie, verify=False)
+        if response.status_code != 200:
+            raise RuntimeError('Count query {} failed, status code {}'.format(uri, response.status_code))
+        return int(response.json()['imdata'][0]['moCount']['attributes']['count'])
+
+    def aci_count_by_node(self, class_name):
+        """ Map each fabric node DN to its count of class objects, None if counting fails """
+        if not self.fabric_inventory:
+            return None
+        node_dns = [device['dn'] for device in self.fabric_inventory]
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_inflight)
+        try:
+            counts = executor.map(lambda node_dn: self.aci_get_node_count(class_name, node_dn), node_dns)
+            return dict(zip(node_dns, counts))
+        except Exception:
+            return None
+        finally:
+            executor.shutdown(wait=False)
+
+    def ports_capacity_doc(self, device, ports):
+        """ Port capacity document for a device from its l1PhysIf objects """
+        ports_up = ports_down = ports_disabled = ports_total = 0
+        for item in ports:
+            ports_total += 1
+            port_info = item['l1PhysIf']['attributes']
+            adminSt = port_info['adminSt']
+            operSt = ''
+            if 'children' in item['l1PhysIf']:
+                if 'ethpmPhysIf' in item['l1PhysIf']['children'][0]:
+                    operSt = item['l1PhysIf']['children'][0]['ethpmPhysIf']['attributes']['operSt']
+
+            if operSt == 'down':
+                if adminSt == 'down':
+                    ports_disabled += 1
+                else:
+                    ports_down += 1
+            elif operSt == 'up':
+                ports_up += 1
+
+        ports_free = ports_total - ports_up
+        ports_util_percent = 100*ports_up/ports_total
+
+        return {'device': device['device'],
+                'site': self.site,
+                'fabric': self.fabric_name,
+                'ports_total': ports_total,
+                'ports_free': ports_free,
+                'ports_disabled': ports_disabled,
+                'ports_down': ports_down,
+                'ports_util_percent': round(ports_util_percent, ndigits=1),
+                'ports_up': ports_up}
+
+    def aci_get_ports_capacity(self, bulk=True):
+        """ Port capacity of each fabric node.
+
+        With bulk set, l1PhysIf (with ethpmPhysIf children) is retrieved once for the whole
+        fabric and bucketed by pod/node from the DN, otherwise one request is made per node.
+        """
         if self.fabric_inventory:
             result = self.refresh_connection()
             if result['rc'] == 1:
                 return {'rc': 1, 'error': result['error']}
             try:
                 elastic_docs = []
+                if bulk:
+                    result = self.aci_get_class('l1PhysIf', sub_classes=['ethpmPhysIf'])
+                    if 'error' in result:
+                        return {'rc': 1, 'error': result['error']}
+                    # Bucket ports by topology/pod-x/node-y
+                    node_ports = {}
+                    for item in result['data']:
+                        node_dn = '/'.join(item['l1PhysIf']['attributes']['dn'].split('/')[0:3])
+                        node_ports.setdefault(node_dn, []).append(item)
+                    for device in self.fabric_inventory:
+                        if node_ports.get(device['dn']):
+                            elastic_docs.append(self.ports_capacity_doc(device, node_ports[device['dn']]))
+                    if elastic_docs:
+                        return {'rc': 0, 'data': elastic_docs }
+                    return None
                 for device in self.fabric_inventory:
 
-                    ports_up = ports_down = ports_disabled = ports_total = 0
-
                     dn = device['dn']
                     pod = dn.split('/')[1].replace('pod-', '').strip()
                     node = dn.split('/')[2].replace('node-', '').strip()
                     uri = "https://{0}/api/node/class/topology/pod-{1}/node-{2}/l1PhysIf.json?rsp-subtree=children" \
                               "&rsp-subtree-class=ethpmPhysIf".format(self.apic_address, pod, node)
 
-                    response = self.session.get(uri, headers=self.headers, cookies=self.cookie, verify=False)
+                    response = self.http_get(uri, headers=self.headers, cookies=self.cookie, verify=False)
                     
                     if response.status_code == 200:
  
                         response_data = response.json()
 
                         if response_data['imdata']:
-
-                            for item in response_data['imdata']:
-                                ports_total += 1
-                                port_info = item['l1PhysIf']['attributes']
-                                adminSt = port_info['adminSt']
-                                operSt = ''
-                                if 'children' in item['l1PhysIf']:
-                                    if 'ethpmPhysIf' in item['l1PhysIf']['children'][0]:
-                                        operSt = item['l1PhysIf']['children'][0]['ethpmPhysIf']['attributes']['operSt']
-                               
-                                if operSt == 'down':
-                                    if adminSt == 'down':
-                                        ports_disabled += 1
-                                    else:
-                                        ports_down += 1
-                                elif operSt == 'up':
-                                    ports_up += 1
-
-
-                            ports_free = ports_total - ports_up
-                            ports_util_percent = 100*ports_up/ports_total
-
-                            elastic_docs.append({'device': device['device'],
-                                                 'site': self.site,
-                                                 'fabric': self.fabric_name,
-                                                 'ports_total': ports_total,
-                                                 'ports_free': ports_free,
-                                                 'ports_disabled': ports_disabled,
-                                                 'ports_down': ports_down,
-                                                 'ports_util_percent': round(ports_util_percent, ndigits=1),
-                                                 'ports_up': ports_up})
+                            elastic_docs.append(self.ports_capacity_doc(device, response_data['imdata']))
                 if elastic_docs:
                     return {'rc': 0, 'data': elastic_docs }
 
@@ -290,20 +510,26 @@ class Apic():
 
         
 
-def count_by_pod_node(apic, fabric_name, mo):
+def count_by_pod_node(apic, fabric_name, mo, server_count=False):
     mo_elastic_docs = []
     doc_counts = {}
     count_field = mo + '_count'
-    result = apic.aci_get_class(mo)
-    docs = result['data']
-    # Set hlq-dn for each doc. hlq format is topology/pod/node
-    for doc in docs:
-        if doc.get(mo):
-            dn_hlq = '/'.join(doc[mo]['attributes']['dn'].split('/')[0:3])
-            if dn_hlq in doc_counts.keys():
-                doc_counts[dn_hlq] += 1
-            else:
-                doc_counts[dn_hlq] = 1
+    # With server_count the APIC counts the objects on each fabric node, objects are only
+    # downloaded (dn attribute only) when that fails.
+    node_counts = apic.aci_count_by_node(mo) if server_count else None
+    if node_counts is not None:
+        doc_counts = dict((node_dn, count) for node_dn, count in node_counts.items() if count)
+    else:
+        # Objects are counted as they are retrieved, one page at a time when paging is enabled.
+        docs = apic.aci_iter_class(mo, prop_include='naming-only')
+        # Set hlq-dn for each doc. hlq format is topology/pod/node
+        for doc in docs:
+            if doc.get(mo):
+                dn_hlq = '/'.join(doc[mo]['attributes']['dn'].split('/')[0:3])
+                if dn_hlq in doc_counts.keys():
+                    doc_counts[dn_hlq] += 1
+                else:
+                    doc_counts[dn_hlq] = 1
     for doc_hlq, doc_count in doc_counts.items():
         pod = doc_hlq.split('/')[1]
         node = doc_hlq.split('/')[2]
@@ -318,6 +544,624 @@ def count_by_pod_node(apic, fabric_name, mo):
         mo_elastic_docs.append(mo_elastic_doc)
     return mo_elastic_docs
 
+class QueryPlan():
+    """ Run named steps on a thread pool, at most max_inflight at a time.
+
+    Each step is called with the results of the steps it needs, and starts as soon as
+    those have finished. Independent APIC queries therefore run concurrently over the
+    shared authenticated session.
+    """
+
+    def __init__(self, max_inflight=4):
+        self.max_inflight = max_inflight
+        self.steps = {}
+
+    def add(self, name, func, needs=()):
+        self.steps[name] = (func, tuple(needs))
+
+    def run(self):
+        results = {}
+        waiting = dict(self.steps)
+        running = {}
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_inflight)
+        try:
+            while waiting or running:
+                for name, (func, needs) in list(waiting.items()):
+                    if all(need in results for need in needs):
+                        future = executor.submit(func, *[results[need] for need in needs])
+                        running[future] = name
+                        del waiting[name]
+                if not running:
+                    raise ValueError('Unresolved query plan steps: {}'.format(', '.join(waiting)))
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        finally:
+            executor.shutdown(wait=False)
+        return results
+
+# Classes the policy index is built from
+policy_classes = ['vzFilter', 'vzEntry', 'vzSubj', 'vzRsSubjFiltAtt']
+
+def policy_signature(apic):
+    """ Count and latest modTs of each policy class, one small query per class.
+
+    Added or modified objects move the latest modTs, deleted objects change the count,
+    so the policy objects themselves are only downloaded when the signature changes.
+    """
+    return tuple(apic.aci_class_signature(class_name) for class_name in policy_classes)
+
+def resolve_dn(tdn, tenant_name, prefix, name):
+    """ Target DN of a relation, or its name resolved in the tenant then in common """
+    if tdn:
+        return [tdn]
+    return ['uni/tn-{}/{}-{}'.format(tenant_name, prefix, name), 'uni/tn-common/{}-{}'.format(prefix, name)]
+
+class PolicyIndex():
+    """ Contracts resolved once to their flattened filter entries, keyed by DN.
+
+    Filters (vzFilter/vzEntry) are keyed by filter DN and subjects (vzSubj/vzRsSubjFiltAtt)
+    by the contract DN they belong to, so names that are reused across tenants do not
+    collide. The index is kept across cycles while its policy_signature() is unchanged.
+    """
+
+    def __init__(self, vzfilter_result, vzsubj_result, signature=None):
+        self.signature = signature
+        # filter dn -> list of entries
+        filters = {}
+        for vzFilter in vzfilter_result['data']:
+            filter_dn = vzFilter['vzFilter']['attributes']['dn']
+            filter_name = vzFilter['vzFilter']['attributes']['name']
+            filters[filter_dn] = []
+            for child in vzFilter['vzFilter'].get('children', []):
+                attributes = child['vzEntry']['attributes']
+                filters[filter_dn].append({'filter': filter_name,
+                                           'entry_name': attributes['name'],
+                                           'prot': attributes['prot'],
+                                           'from_port': attributes['sFromPort'],
+                                           'to_port': attributes['sToPort']})
+        # contract dn -> flattened entries of all its subjects' filters
+        self.contract_entries = {}
+        for vzSubj in vzsubj_result['data']:
+            subject_dn = vzSubj['vzSubj']['attributes']['dn']
+            # eg. uni/tn-common/brc-web/subj-http
+            contract_dn = '/'.join(subject_dn.split('/')[:-1])
+            tenant_name = subject_dn.split('/')[1].replace('tn-', '')
+            entries = self.contract_entries.setdefault(contract_dn, [])
+            for child in vzSubj['vzSubj'].get('children', []):
+                attributes = child['vzRsSubjFiltAtt']['attributes']
+                filter_name = attributes.get('tnVzFilterName') or attributes['tRn'].replace('flt-', '')
+                for filter_dn in resolve_dn(attributes.get('tDn'), tenant_name, 'flt', filter_name):
+                    if filter_dn in filters:
+                        entries.extend(filters[filter_dn])
+                        break
+
+    def entries(self, tdn, tenant_name, contract_name):
+        for contract_dn in resolve_dn(tdn, tenant_name, 'brc', contract_name):
+            if contract_dn in self.contract_entries:
+                return self.contract_entries[contract_dn]
+        return []
+
+# Policy index by fabric name, kept across collection cycles
+policy_indexes = {}
+
+def get_policy_index(apic, fabric_name):
+    """ Return the fabric's policy index, rebuilding it only when the policy objects changed """
+    signature = policy_signature(apic)
+    policy_index = policy_indexes.get(fabric_name)
+    if policy_index is None or policy_index.signature != signature:
+        vzfilter_result = apic.aci_get_class('vzFilter', sub_classes=['vzEntry'])
+        vzsubj_result = apic.aci_get_class('vzSubj', sub_classes=['vzRsSubjFiltAtt'])
+        for result in [vzfilter_result, vzsubj_result]:
+            if 'error' in result:
+                raise RuntimeError('; '.join(result['error']))
+        policy_index = PolicyIndex(vzfilter_result, vzsubj_result, signature)
+        policy_indexes[fabric_name] = policy_index
+    return policy_index
+
+def epg_contract_docs(apic, fabric_name, result, policy_index):
+    # fvAEPgs and related contracts, provide (fvRsProv) and consume (fvRsCons)
+    elastic_docs = []
+    fvAEPgs = result['data']
+    for fvAEPg in fvAEPgs:
+        dn = fvAEPg['fvAEPg']['attributes']['dn']
+        hlq = '/'.join(dn.split('/')[0:5])
+        tenant_name = dn.split('/')[1].replace('tn-', '')
+        app_name = dn.split('/')[2].replace('ap-', '')
+        epg_name = dn.split('/')[3].replace('epg-', '')
+        children = fvAEPg['fvAEPg'].get('children')
+        if children:
+            for child in children:
+                for contract_direction, attributes in child.items():
+                    attributes = attributes['attributes']
+                    contract_name = attributes.get('tnVzBrCPName') or attributes['tRn'].replace('brc-', '')
+                    epg_doc = {}
+                    epg_doc['mo'] = 'fvAEPg'
+                    epg_doc['hlq'] = fabric_name + '/' + hlq
+                    epg_doc['tenant'] = tenant_name
+                    epg_doc['ap'] = app_name
+                    epg_doc['epg'] = epg_name
+                    epg_doc['site'] = apic.site
+                    epg_doc['fabric'] = fabric_name
+                    epg_doc['contract'] = contract_name
+                    epg_doc['contract_direction'] = contract_direction
+                    for filter_entry in policy_index.entries(attributes.get('tDn'), tenant_name, contract_name):
+                        doc = dict(epg_doc)
+                        doc.update(filter_entry)
+                        elastic_docs.append(doc)
+    return elastic_docs
+
+def endpoint_doc_list(fabric_name, site, dn, encap, mac, ips):
+    """ Documents for one endpoint, one per fvIp address or a single document without an address """
+    hlq = '/'.join(dn.split('/')[0:5])
+    tenant = dn.split('/')[1].replace('tn-', '')
+    ap = dn.split('/')[2].replace('ap-', '')
+    epg = dn.split('/')[3].replace('epg-', '')
+    elastic_docs = []
+    for ip in ips or ['']:
+        elastic_doc = {}
+        elastic_doc['mo'] = 'fvCEp'
+        elastic_doc['hlq'] = fabric_name + '/' + hlq
+        elastic_doc['tenant'] = tenant
+        elastic_doc['ap'] = ap
+        elastic_doc['epg'] = epg
+        elastic_doc['site'] = site
+        elastic_doc['fabric'] = fabric_name
+        elastic_doc['encap'] = encap
+        elastic_doc['mac'] = mac
+        elastic_doc['fvIp'] = ip
+        elastic_docs.append(elastic_doc)
+    return elastic_docs
+
+def endpoint_docs(apic, fabric_name, result):
+    # fvCEp and child fvIp objects
+    elastic_docs = []
+    docs = result['data']
+    for doc in docs:
+        if doc.get('fvCEp'):
+            dn = doc['fvCEp']['attributes']['dn']
+            # Filter out non-epg endpoints
+            # eg. uni/tn-common/ctx-e-eu1/cep-E8:98:6D:54:E0:12   
+            if 'ctx-' not in dn:
+                # May return NONE
+                fvIps = doc['fvCEp'].get('children') or []
+                ips = [fvIp['fvIp']['attributes'].get('addr') for fvIp in fvIps]
+                elastic_docs.extend(endpoint_doc_list(fabric_name, apic.site, dn,
+                                                      doc['fvCEp']['attributes']['encap'],
+                                                      doc['fvCEp']['attributes']['mac'], ips))
+    return elastic_docs
+
+def rpm_entity_docs(apic, fabric_name, result):
+    # rpmEntity objects
+    elastic_docs = []
+    docs = result['data']
+    for doc in docs:
+        if doc.get('rpmEntity'):
+            dn = doc['rpmEntity']['attributes']['dn']
+            hlq = '/'.join(dn.split('/')[0:3])
+            pod = dn.split('/')[1]
+            node = dn.split('/')[2]
+            elastic_doc = {}
+            elastic_doc['mo'] = 'rpmEntity'
+            elastic_doc['hlq'] = fabric_name + '/' + hlq
+            elastic_doc['pod'] = pod
+            elastic_doc['node'] = node
+            elastic_doc['site'] = apic.site
+            elastic_doc['fabric'] = fabric_name
+            elastic_doc['shMemAllocFailCount'] = int(doc['rpmEntity']['attributes']['shMemAllocFailCount'])
+            elastic_doc['shMemTotal'] = int(doc['rpmEntity']['attributes']['shMemTotal'])
+            elastic_doc['shMemUsage'] = int(doc['rpmEntity']['attributes']['shMemUsage'])
+            elastic_doc['shMemAlert'] = doc['rpmEntity']['attributes']['shMemAlert']
+            elastic_docs.append(elastic_doc)
+    return elastic_docs
+
+def l3out_nodes_by_class(result):
+    """ Map L3Out DN to the node tDn of each l3extRsNodeL3OutAtt under its node profiles """
+    if 'error' in result:
+        return None
+    l3out_nodes = {}
+    for l3outattr in result['data']:
+        attributes = l3outattr['l3extRsNodeL3OutAtt']['attributes']
+        # eg. uni/tn-common/out-l3out/lnodep-np/rsnodeL3OutAtt-[topology/pod-1/node-101]
+        node_prof_dn = attributes['dn'].split('/rsnodeL3OutAtt-[')[0]
+        l3out_dn = '/'.join(node_prof_dn.split('/')[:-1])
+        l3out_nodes.setdefault(l3out_dn, []).append(attributes['tDn'])
+    return l3out_nodes
+
+def l3out_nodes_by_mo(apic, l3out_dn):
+    """ Node tDns of an L3Out, walking its node profiles with aci_get_mo() """
+    node_tdns = []
+    result = apic.aci_get_mo(l3out_dn, 'l3extLNodeP')
+    l3outs_with_children = result.get('data', [])
+    for l3out_with_children in l3outs_with_children:
+        if 'children' in l3out_with_children['l3extOut']:
+            node_profs = l3out_with_children['l3extOut']['children']
+            for node_prof in node_profs:
+                node_prof_rn = node_prof['l3extLNodeP']['attributes']['rn']
+                node_prof_dn = l3out_dn + '/' + node_prof_rn
+                result = apic.aci_get_mo(node_prof_dn, 'l3extRsNodeL3OutAtt')
+                node_profs_with_children = result.get('data', [])
+                for node_prof_with_children in node_profs_with_children:
+                    l3outattrs = node_prof_with_children['l3extLNodeP'].get('children', [])
+                    for l3outattr in l3outattrs:
+                        node_tdns.append(l3outattr['l3extRsNodeL3OutAtt']['attributes']['tDn'])
+    return node_tdns
+
+def ext_epg_node_docs(apic, fabric_name, mo, result, l3out_nodes=None):
+    # External EPGs (fvRtdEpP or l3extInstP) counted by the nodes of their L3Out.
+    # l3out_nodes comes from one l3extRsNodeL3OutAtt class query, when it is not available
+    # each L3Out is walked with (cached) aci_get_mo() calls.
+    elastic_docs = []
+    epg_counts = {}
+    count_field = mo + '_count'
+    ext_epgs = result['data']
+    for ext_epg in ext_epgs:
+        ext_epg_dn = ext_epg[mo]['attributes']['dn']
+        if mo == 'fvRtdEpP':
+            # eg. uni/epp/rtd-[uni/tn-common/out-l3out/instP-ext-epg]
+            l3out_dn = '/'.join(ext_epg_dn.split('[')[1].split('/')[:-1])
+        else:
+            l3out_dn = '/'.join(ext_epg_dn.split('/')[:-1])
+        if l3out_nodes is not None:
+            node_tdns = l3out_nodes.get(l3out_dn, [])
+        else:
+            node_tdns = l3out_nodes_by_mo(apic, l3out_dn)
+        for hlq in node_tdns:
+            if hlq in epg_counts.keys():
+                epg_counts[hlq] += 1
+            else:
+                epg_counts[hlq] = 1
+    for epg_hlq, epg_count in epg_counts.items():
+        pod = epg_hlq.split('/')[1]
+        node = epg_hlq.split('/')[2]
+        elastic_doc = {}
+        elastic_doc['mo'] = mo
+        elastic_doc['hlq'] = fabric_name + '/' + epg_hlq
+        elastic_doc['pod'] = pod
+        elastic_doc['node'] = node
+        elastic_doc['site'] = apic.site
+        elastic_doc['fabric'] = fabric_name
+        elastic_doc[count_field] = epg_count
+        elastic_docs.append(elastic_doc)
+    return elastic_docs
+
+def checked(result, logger):
+    """ Log errors from a failed APIC call, returns the result data or None """
+    if result is None:
+        return None
+    if result['rc'] != 0:
+        for error in result.get('error', []):
+            logger.info(error)
+        if 'error' in result:
+            return None
+    return result.get('data', [])
+
+class EndpointTracker():
+    """ In-memory fvCEp/fvIp endpoint table of one fabric, kept up to date by APIC events.
+
+    The subscription queries load the table (the snapshot), after which created, modified
+    and deleted events arrive over the APIC WebSocket. collect() returns documents for the
+    endpoints that changed since the previous cycle, and documents for the whole table
+    every snapshot_cycles cycles, without querying the APIC.
+    """
+
+    def __init__(self, **kwargs):
+        self.fabrics = kwargs['fabrics']
+        self.fabric_name = kwargs['fabric_name']
+        self.logger = kwargs['logger']
+        self.snapshot_cycles = kwargs.get('snapshot_cycles', 10)
+        self.refresh_interval = kwargs.get('refresh_interval', 30)
+        # The snapshot is paged like class queries when page_size is set
+        self.page_size = kwargs.get('page_size')
+        self.apic = None
+        self.ws = None
+        self.subscription_ids = []
+        # fvCEp dn -> {'encap', 'mac', 'ips': {fvIp dn: addr}}
+        self.endpoints = {}
+        # fvCEp dn -> (event, endpoint) since the last collect()
+        self.changes = {}
+        # Events received while the snapshot is loading
+        self.pending = None
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+        self.cycles = 0
+
+    def start(self):
+        """ Log in, open the WebSocket and subscribe, returns True when the table is loaded """
+        self.stop()
+        self.stopped = threading.Event()
+        self.apic = Apic(fabrics=self.fabrics, page_size=self.page_size)
+        login_result = self.apic.login(self.fabric_name)
+        if login_result['rc'] != 0:
+            for error in login_result['error']:
+                self.logger.info(error)
+            return False
+        opened = threading.Event()
+        url = 'wss://{}/socket{}'.format(self.apic.apic_address, self.apic.cookie['APIC-cookie'])
+        self.ws = websocket.WebSocketApp(url, on_open=lambda ws: opened.set(), on_message=self.on_message,
+                                         on_error=self.on_error, on_close=self.on_close)
+        threading.Thread(target=self.ws.run_forever, kwargs={'sslopt': {'cert_reqs': ssl.CERT_NONE}},
+                         daemon=True).start()
+        if not opened.wait(10):
+            self.logger.error(f'Fabric {self.fabric_name}: failed to open APIC WebSocket.')
+            return False
+        with self.lock:
+            self.endpoints = {}
+            self.changes = {}
+            self.pending = []
+        # Events for IP addresses are delivered by a separate fvIp subscription.
+        fvcep_result = self.apic.aci_subscribe_class('fvCEp', sub_classes=['fvIp'])
+        fvip_result = self.apic.aci_subscribe_class('fvIp', prop_include='naming-only')
+        for result in [fvcep_result, fvip_result]:
+            if result['rc'] != 0:
+                for error in result['error']:
+                    self.logger.error(error)
+                return False
+        self.subscription_ids = fvcep_result['subscription_ids'] + fvip_result['subscription_ids']
+        with self.lock:
+            for doc in fvcep_result['data']:
+                if doc.get('fvCEp'):
+                    attributes = doc['fvCEp']['attributes']
+                    if 'ctx-' not in attributes['dn']:
+                        self.endpoints[attributes['dn']] = {
+                            'encap': attributes['encap'], 'mac': attributes['mac'],
+                            'ips': dict((fvIp['fvIp']['attributes']['dn'], fvIp['fvIp']['attributes'].get('addr'))
+                                        for fvIp in doc['fvCEp'].get('children') or [])}
+            for class_name, attributes in self.pending:
+                self.apply_event(class_name, attributes)
+            self.pending = None
+            self.changes = {}
+        self.connected.set()
+        threading.Thread(target=self.refresh, args=(self.stopped,), daemon=True).start()
+        self.logger.info(f'Fabric {self.fabric_name}: subscribed to endpoint events, '
+                         f'{len(self.endpoints)} endpoints loaded.')
+        return True
+
+    def stop(self):
+        self.connected.clear()
+        self.stopped.set()
+        if self.ws:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+            self.ws = None
+        if self.apic:
+            self.apic.disconnect()
+            self.apic = None
+
+    def refresh(self, stopped):
+        """ Keep the login token and subscriptions alive, APIC drops them after 60 seconds """
+        while not stopped.wait(self.refresh_interval):
+            try:
+                uri = 'https://{}/api/aaaRefresh.json'.format(self.apic.apic_address)
+                response = self.apic.http_get(uri, headers=self.apic.headers, cookies=self.apic.cookie,
+                                              verify=False, timeout=10)
+                if response.status_code != 200:
+                    raise RuntimeError('aaaRefresh failed, status code {}'.format(response.status_code))
+                for subscription_id in self.subscription_ids:
+                    uri = 'https://{}/api/subscriptionRefresh.json?id={}'.format(self.apic.apic_address,
+                                                                               subscription_id)
+                    response = self.apic.http_get(uri, headers=self.apic.headers, cookies=self.apic.cookie,
+                                                  verify=False, timeout=10)
+                    if response.status_code != 200:
+                        raise RuntimeError('subscriptionRefresh failed, status code {}'.format(
+                            response.status_code))
+            except Exception as error:
+                self.logger.error(f'Fabric {self.fabric_name}: endpoint subscription lost: {str(error)}')
+                self.connected.clear()
+                return
+
+    def on_message(self, ws, message):
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return
+        with self.lock:
+            for item in event.get('imdata', []):
+                for class_name, body in item.items():
+                    if self.pending is not None:
+                        self.pending.append((class_name, body['attributes']))
+                    else:
+                        self.apply_event(class_name, body['attributes'])
+
+    def on_error(self, ws, error):
+        self.logger.error(f'Fabric {self.fabric_name}: APIC WebSocket error: {str(error)}')
+        self.connected.clear()
+
+    def on_close(self, *args):
+        self.connected.clear()
+
+    def apply_event(self, class_name, attributes):
+        dn = attributes['dn']
+        status = attributes.get('status') or 'modified'
+        if class_name == 'fvCEp':
+            if 'ctx-' in dn:
+                return
+            if status == 'deleted':
+                endpoint = self.endpoints.pop(dn, None)
+                if endpoint:
+                    self.changes[dn] = ('deleted', endpoint)
+                return
+            endpoint = self.endpoints.setdefault(dn, {'encap': '', 'mac': '', 'ips': {}})
+            for key in ['encap', 'mac']:
+                if key in attributes:
+                    endpoint[key] = attributes[key]
+            self.mark(dn, status)
+        elif class_name == 'fvIp':
+            # eg. uni/tn-common/ap-app/epg-web/cep-E8:98:6D:54:E0:12/ip-[10.0.0.1]
+            cep_dn, _, addr = dn.partition('/ip-[')
+            endpoint = self.endpoints.get(cep_dn)
+            if endpoint is None:
+                return
+            if status == 'deleted':
+                endpoint['ips'].pop(dn, None)
+            else:
+                endpoint['ips'][dn] = attributes.get('addr') or addr.rstrip(']')
+            self.mark(cep_dn, 'modified')
+
+    def mark(self, dn, status):
+        # An endpoint created since the last cycle stays 'created' when it is modified again.
+        if self.changes.get(dn, ('',))[0] != 'created':
+            self.changes[dn] = (status, self.endpoints[dn])
+
+    def collect(self, site):
+        """ Change documents, or a snapshot of the table on (re)subscription and every snapshot_cycles """
+        if not self.connected.is_set():
+            if not self.start():
+                self.stop()
+                return None
+            self.cycles = 0
+            snapshot = True
+        else:
+            self.cycles += 1
+            snapshot = self.cycles % self.snapshot_cycles == 0
+        elastic_docs = []
+        with self.lock:
+            if snapshot:
+                for dn, endpoint in self.endpoints.items():
+                    elastic_docs.extend(endpoint_doc_list(self.fabric_name, site, dn, endpoint['encap'],
+                                                          endpoint['mac'], list(endpoint['ips'].values())))
+            # Deleted endpoints are not in the snapshot, they are always sent as changes.
+            for dn, (status, endpoint) in self.changes.items():
+                if status == 'deleted' or not snapshot:
+                    for elastic_doc in endpoint_doc_list(self.fabric_name, site, dn, endpoint['encap'],
+                                                         endpoint['mac'], list(endpoint['ips'].values())):
+                        elastic_doc['event'] = status
+                        elastic_docs.append(elastic_doc)
+            self.changes = {}
+        self.logger.info(f'Fabric {self.fabric_name}: {len(self.endpoints)} endpoints tracked, '
+                         f'{"snapshot" if snapshot else "changes"} of {len(elastic_docs)} documents.')
+        return elastic_docs
+
+# Endpoint trackers by fabric name, kept across collection cycles
+endpoint_trackers = {}
+
+def endpoint_tracker(config_data, fabric_name, logger):
+    """ Return the EndpointTracker of a fabric when aci_endpoint_subscription is set """
+    if not config_data.get('aci_endpoint_subscription'):
+        return None
+    if websocket is None:
+        logger.warning('aci_endpoint_subscription requires the websocket-client package, polling endpoints.')
+        return None
+    if fabric_name not in endpoint_trackers:
+        endpoint_trackers[fabric_name] = EndpointTracker(fabrics=config_data['inventory'], fabric_name=fabric_name,
+                                                         logger=logger,
+                                                         snapshot_cycles=config_data.get(
+                                                             'aci_endpoint_snapshot_cycles', 10),
+                                                         page_size=config_data.get('aci_page_size'))
+    return endpoint_trackers[fabric_name]
+
+# Operations that can have their own interval in the op schedule:
+# contracts (fvAEPg contract/filter documents), endpoints (fvCEp), fabric_inventory (fabricNode),
+# port_capacity, rpm_entity, route_counts (rtmap/rtpfx/actrl counts per node) and
+# external_epgs (fvRtdEpP and l3extInstP node documents).
+aci_ops = ['contracts', 'endpoints', 'fabric_inventory', 'port_capacity', 'rpm_entity', 'route_counts',
+           'external_epgs']
+
+def collect_fabric(config_data, fabric_name, logger, debug=False):
+    """ Collect documents from a single fabric with its own APIC session """
+    # apic_max_inflight limits the number of concurrent requests to the APIC, defaults to 4.
+    max_inflight = config_data.get('apic_max_inflight', 4)
+    # Instantiate APIC, class queries are paged when aci_page_size is set.
+    apic = Apic(fabrics=config_data['inventory'], page_size=config_data.get('aci_page_size'),
+                parallel_pages=config_data.get('aci_parallel_pages', 1), max_inflight=max_inflight)
+    elastic_docs = []
+    login_result = apic.login(fabric_name)
+    if login_result['rc'] != 0:
+        for error in login_result['error']:
+            logger.info(error)
+            return []
+    # Operations in ops_skipped are not due this cycle, see the op schedule in basebeat.
+    ops_skipped = config_data.get('ops_skipped', [])
+    due = {op: op not in ops_skipped for op in aci_ops}
+    plan = QueryPlan(max_inflight)
+    # Class queries, independent of each other
+    if due['contracts']:
+        plan.add('policy_index', lambda: get_policy_index(apic, fabric_name))
+        plan.add('fvAEPg', lambda: apic.aci_get_class('fvAEPg', sub_classes=['fvRsProv', 'fvRsCons']))
+    # Endpoints are polled unless they are tracked by APIC subscription events
+    tracker = endpoint_tracker(config_data, fabric_name, logger)
+    if due['endpoints'] and tracker is None:
+        plan.add('fvCEp', lambda: apic.aci_get_class('fvCEp', sub_classes=['fvIp']))
+    # Port capacity and route counts also need the fabric inventory
+    if due['fabric_inventory'] or due['port_capacity'] or due['route_counts']:
+        plan.add('fabricNode', apic.aci_get_fabric_inventory)
+    if due['rpm_entity']:
+        plan.add('rpmEntity', lambda: apic.aci_get_class('rpmEntity'))
+    if due['external_epgs']:
+        plan.add('fvRtdEpP', lambda: apic.aci_get_class('fvRtdEpP'))
+        plan.add('l3extInstP', lambda: apic.aci_get_class('l3extInstP'))
+        plan.add('l3extRsNodeL3OutAtt', lambda: apic.aci_get_class('l3extRsNodeL3OutAtt'))
+    # aci_server_count counts objects per node on the APIC instead of downloading them, one request
+    # per node and class, defaults to False.
+    server_count = config_data.get('aci_server_count', False)
+    if due['route_counts']:
+        for mo in ['rtmapRule', 'rtmapEntry', 'rtpfxEntry', 'actrlPfxEntry', 'actrlRule']:
+            plan.add(mo + '_count', lambda inventory_result, mo=mo:
+                     count_by_pod_node(apic, fabric_name, mo, server_count), needs=['fabricNode'])
+    # Dependent steps, each waits only on its own inputs
+    if due['contracts']:
+        plan.add('fvAEPg_docs', lambda result, policy_index: epg_contract_docs(apic, fabric_name, result, policy_index),
+                 needs=['fvAEPg', 'policy_index'])
+    # aci_bulk_port_capacity retrieves ports for the whole fabric in one query, defaults to True.
+    bulk_ports = config_data.get('aci_bulk_port_capacity', True)
+    if due['port_capacity']:
+        plan.add('ports_capacity', lambda inventory_result: apic.aci_get_ports_capacity(bulk=bulk_ports),
+                 needs=['fabricNode'])
+    if due['external_epgs']:
+        plan.add('l3out_nodes', l3out_nodes_by_class, needs=['l3extRsNodeL3OutAtt'])
+        plan.add('fvRtdEpP_docs', lambda result, l3out_nodes:
+                 ext_epg_node_docs(apic, fabric_name, 'fvRtdEpP', result, l3out_nodes),
+                 needs=['fvRtdEpP', 'l3out_nodes'])
+        plan.add('l3extInstP_docs', lambda result, l3out_nodes:
+                 ext_epg_node_docs(apic, fabric_name, 'l3extInstP', result, l3out_nodes),
+                 needs=['l3extInstP', 'l3out_nodes'])
+    results = plan.run()
+    if due['contracts']:
+        elastic_docs.extend(results['fvAEPg_docs'])
+    if due['endpoints']:
+        endpoint_event_docs = tracker.collect(apic.site) if tracker else None
+        if endpoint_event_docs is not None:
+            elastic_docs.extend(endpoint_event_docs)
+        else:
+            # fvCEp, fabric inventory, port capacity and rpmEntity failures abandon the fabric.
+            if 'fvCEp' not in results:
+                results['fvCEp'] = apic.aci_get_class('fvCEp', sub_classes=['fvIp'])
+            data = checked(results['fvCEp'], logger)
+            if data is None:
+                return []
+            elastic_docs.extend(endpoint_docs(apic, fabric_name, results['fvCEp']))
+    for step, op in [('fabricNode', 'fabric_inventory'), ('ports_capacity', 'port_capacity')]:
+        if not due[op]:
+            continue
+        data = checked(results[step], logger)
+        if data is None:
+            return []
+        elastic_docs.extend(data)
+    if due['rpm_entity']:
+        if checked(results['rpmEntity'], logger) is None:
+            return []
+        elastic_docs.extend(rpm_entity_docs(apic, fabric_name, results['rpmEntity']))
+    if due['route_counts']:
+        elastic_docs.extend(results['rtmapRule_count'])
+        elastic_docs.extend(results['rtmapEntry_count'])
+        elastic_docs.extend(results['rtpfxEntry_count'])
+    if due['external_epgs']:
+        elastic_docs.extend(results['fvRtdEpP_docs'])
+    if due['route_counts']:
+        elastic_docs.extend(results['actrlPfxEntry_count'])
+        elastic_docs.extend(results['actrlRule_count'])
+    if due['external_epgs']:
+        elastic_docs.extend(results['l3extInstP_docs'])
+    if debug:
+        pprint(elastic_docs)
+    apic.disconnect()
+    # Every operation due has completed for this fabric, an operation completed on any fabric counts.
+    config_data.get('ops_completed', []).extend(op for op in aci_ops if due[op])
+    return elastic_docs
+
 # evobeat calls this function with config_data
 def collect_data(config_data):
     # Set Logger
@@ -327,259 +1171,23 @@ def collect_data(config_data):
         debug = True
     else:
         debug = False
-    # Instantiate APIC
-    apic = Apic(fabrics=config_data['inventory'])
+    fabric_names = list(config_data['inventory'].keys())
+    # max_workers defaults to one worker per fabric.
+    max_workers = config_data.get('max_workers', len(fabric_names)) or 1
+    # fabric_timeout (seconds) defaults to 300, a fabric that takes longer is abandoned for this cycle.
+    fabric_timeout = config_data.get('fabric_timeout', 300)
     elastic_docs = []
-    for fabric_name in config_data['inventory'].keys():
-        login_result = apic.login(fabric_name)
-        if login_result['rc'] != 0:
-            for error in login_result['error']:
-                logger.info(error)
-                return []
-        # Get filters (vzFilter) and entries (vzEntry)
-        vzfilters = {}
-        result = apic.aci_get_class('vzFilter', sub_classes=['vzEntry'])
-        vzFilters = result['data']
-        for vzFilter in vzFilters:
-            filter_name = vzFilter['vzFilter']['attributes']['name']
-            vzfilters[filter_name] = []
-            for child in vzFilter['vzFilter']['children']:
-                entry_name = child['vzEntry']['attributes']['name']
-                entry_prot = child['vzEntry']['attributes']['prot']
-                entry_from_port = child['vzEntry']['attributes']['sFromPort']
-                entry_to_port = child['vzEntry']['attributes']['sToPort']
-                entry = {'name': entry_name, 'prot': entry_prot, 'from_port': entry_from_port, 'to_port': entry_to_port}
-                vzfilters[filter_name].append(entry)
-        # Get contracts (vzBrCP) and subjects (vzSubj)
-        contracts = {}
-        result = apic.aci_get_class('vzBrCP', sub_classes=['vzSubj'])
-        vzBrCPs = result['data']
-        for vzBrCP in vzBrCPs:
-            contract_name = vzBrCP['vzBrCP']['attributes']['name']
-            contracts[contract_name] = []
-            children = vzBrCP['vzBrCP'].get('children')
-            if children:
-                for child in children:
-                    for vzSubj, attributes in child.items():
-                        subject_name = attributes['attributes']['name']
-                        contracts[contract_name].append(subject_name)
-        # Get subjects (vzSubj) and filter attributes (vzRsSubjFiltAtt)
-        subjects = {}
-        result = apic.aci_get_class('vzSubj', sub_classes=['vzRsSubjFiltAtt'])
-        vzSubjs = result['data']
-        for vzSubj in vzSubjs:
-            subject_name = vzSubj['vzSubj']['attributes']['name']
-            children = vzSubj['vzSubj'].get('children')
-            if children:
-                for child in children:
-                    filter_name = child['vzRsSubjFiltAtt']['attributes']['tRn'].replace('flt-', '')
-                    subjects[subject_name] = filter_name
-        # Get fvAEPgs and related contracts, provide (fvRsProv) and consume (fvRsCons)
-        epgs = []
-        result = apic.aci_get_class('fvAEPg', sub_classes=['fvRsProv', 'fvRsCons'])
-        fvAEPgs = result['data']
-        for fvAEPg in fvAEPgs:
-            dn = fvAEPg['fvAEPg']['attributes']['dn']
-            hlq = '/'.join(dn.split('/')[0:5])
-            tenant_name = dn.split('/')[1].replace('tn-', '')
-            app_name = dn.split('/')[2].replace('ap-', '')
-            epg_name = dn.split('/')[3].replace('epg-', '')
-            children = fvAEPg['fvAEPg'].get('children')
-            if children:
-                for child in children:
-                    for contract_direction, attributes in child.items():
-                        contract_name = attributes['attributes']['tRn'].replace('brc-', '')
-                        subject_names = contracts.get(contract_name, [])
-                        for subject_name in subject_names:
-                            filter_name = subjects[subject_name]
-                            for filter_entry in vzfilters[filter_name]:
-                                doc = {}
-                                doc['mo'] = 'fvAEPg'
-                                doc['hlq'] = fabric_name + '/' + hlq
-                                doc['tenant'] = tenant_name
-                                doc['ap'] = app_name
-                                doc['epg'] = epg_name
-                                doc['site'] = apic.site
-                                doc['fabric'] = fabric_name
-                                doc['contract'] = contract_name
-                                doc['contract_direction'] = contract_direction
-                                doc['filter'] = filter_name
-                                doc['entry_name'] = filter_entry['name']
-                                doc['prot'] = filter_entry['prot']
-                                doc['from_port'] = filter_entry['from_port']
-                                doc['to_port'] = filter_entry['to_port']
-                                elastic_docs.append(doc)
-        # Get fvCEp and child fvIp objects
-        result = apic.aci_get_class('fvCEp', sub_classes=['fvIp'])
-        if result['rc'] != 0:
-            for error in result['error']:
-                logger.info(error)
-                return []
-        docs = result['data']
-        for doc in docs:
-            if doc.get('fvCEp'):
-                dn = doc['fvCEp']['attributes']['dn']
-                # Filter out non-epg endpoints
-                # eg. uni/tn-common/ctx-e-eu1/cep-E8:98:6D:54:E0:12   
-                if 'ctx-' not in dn:
-                    hlq = '/'.join(dn.split('/')[0:5])
-                    tenant = dn.split('/')[1].replace('tn-', '')
-                    ap = dn.split('/')[2].replace('ap-', '')
-                    epg = dn.split('/')[3].replace('epg-', '')
-                    elastic_doc = {}
-                    elastic_doc['mo'] = 'fvCEp'
-                    elastic_doc['hlq'] = fabric_name + '/' + hlq
-                    elastic_doc['tenant'] = tenant
-                    elastic_doc['ap'] = ap
-                    elastic_doc['epg'] = epg
-                    elastic_doc['site'] = apic.site
-                    elastic_doc['fabric'] = fabric_name
-                    elastic_doc['encap'] = doc['fvCEp']['attributes']['encap']
-                    elastic_doc['mac'] = doc['fvCEp']['attributes']['mac']
-                    fvIps = doc['fvCEp'].get('children')
-                    # May return NONE
-                    if fvIps:
-                        for fvIp in fvIps:
-                            ip = fvIp['fvIp']['attributes'].get('addr')
-                            elastic_doc['fvIp'] = ip
-                            elastic_docs.append(elastic_doc)
-                    else:
-                        elastic_doc['fvIp'] = ''
-                        elastic_docs.append(elastic_doc)
-        # Get rpmEntity objects
-        result = apic.aci_get_fabric_inventory()
-        if result['rc'] != 0:
-            for error in result['error']:
-                logger.info(error)
-                return []
-        else:
-            elastic_docs.extend(result['data'])
-        # Get port capacity
-        result = apic.aci_get_ports_capacity()
-        if result['rc'] != 0:
-            for error in result['error']:
-                logger.info(error)
-                return []
-        else:
-            elastic_docs.extend(result['data'])
-        # Get rpmEntity objects
-        result = apic.aci_get_class('rpmEntity')
-        if result['rc'] != 0:
-            for error in result['error']:
-                logger.info(error)
-                return []
-        docs = result['data']
-        for doc in docs:
-            if doc.get('rpmEntity'):
-                dn = doc['rpmEntity']['attributes']['dn']
-                hlq = '/'.join(dn.split('/')[0:3])
-                pod = dn.split('/')[1]
-                node = dn.split('/')[2]
-                elastic_doc = {}
-                elastic_doc['mo'] = 'rpmEntity'
-                elastic_doc['hlq'] = fabric_name + '/' + hlq
-                elastic_doc['pod'] = pod
-                elastic_doc['node'] = node
-                elastic_doc['site'] = apic.site
-                elastic_doc['fabric'] = fabric_name
-                elastic_doc['shMemAllocFailCount'] = int(doc['rpmEntity']['attributes']['shMemAllocFailCount'])
-                elastic_doc['shMemTotal'] = int(doc['rpmEntity']['attributes']['shMemTotal'])
-                elastic_doc['shMemUsage'] = int(doc['rpmEntity']['attributes']['shMemUsage'])
-                elastic_doc['shMemAlert'] = doc['rpmEntity']['attributes']['shMemAlert']
-                elastic_docs.append(elastic_doc)
-        # Get rtmapRule objects
-        elastic_docs.extend(count_by_pod_node(apic, fabric_name, 'rtmapRule'))
-        # Get rtmapEntry objects
-        elastic_docs.extend(count_by_pod_node(apic, fabric_name, 'rtmapEntry'))
-        # Get rtpfxEntry objects
-        elastic_docs.extend(count_by_pod_node(apic, fabric_name, 'rtpfxEntry'))
-        # # Get fvRtdEpP objects
-        epg_counts = {}
-        count_field = 'fvRtdEpP' + '_count'
-        result = apic.aci_get_class('fvRtdEpP')
-        ext_epgs = result['data']
-        for ext_epg in ext_epgs:
-            ext_epg_dn = ext_epg['fvRtdEpP']['attributes']['dn']
-            l3out_dn = '/'.join(ext_epg_dn.split('[')[1].split('/')[:-1])
-            result = apic.aci_get_mo(l3out_dn, 'l3extLNodeP')
-            l3outs_with_children = result['data']
-            for l3out_with_children in l3outs_with_children:
-                if 'children' in l3out_with_children['l3extOut']:
-                    node_profs = l3out_with_children['l3extOut']['children']
-                    for node_prof in node_profs:
-                        node_prof_rn = node_prof['l3extLNodeP']['attributes']['rn']
-                        node_prof_dn = l3out_dn + '/' + node_prof_rn
-                        result = apic.aci_get_mo(node_prof_dn, 'l3extRsNodeL3OutAtt')
-                        node_profs_with_children = result['data']
-                        for node_prof_with_children in node_profs_with_children:
-                            l3outattrs = node_prof_with_children['l3extLNodeP']['children']
-                            for l3outattr in l3outattrs:
-                                hlq = l3outattr['l3extRsNodeL3OutAtt']['attributes']['tDn']
-                                if hlq in epg_counts.keys():
-                                    epg_counts[hlq] += 1
-                                else:
-                                    epg_counts[hlq] = 1
-        for epg_hlq, epg_count in epg_counts.items():
-            pod = epg_hlq.split('/')[1]
-            node = epg_hlq.split('/')[2]
-            elastic_doc = {}
-            elastic_doc['mo'] = 'fvRtdEpP'
-            elastic_doc['hlq'] = fabric_name + '/' + epg_hlq
-            elastic_doc['pod'] = pod
-            elastic_doc['node'] = node
-            elastic_doc['site'] = apic.site
-            elastic_doc['fabric'] = fabric_name
-            elastic_doc[count_field] = epg_count
-            elastic_docs.append(elastic_doc)
-        # Get actrlPfxEntry objects
-        elastic_docs.extend(count_by_pod_node(apic, fabric_name, 'actrlPfxEntry'))
-        # Get actrlRule objects
-        elastic_docs.extend(count_by_pod_node(apic, fabric_name, 'actrlRule'))
-        # Get l3extInstP objects
-        epg_counts = {}
-        count_field = 'l3extInstP' + '_count'
-        result = apic.aci_get_class('l3extInstP')
-        ext_epgs = result['data']
-    for ext_epg in ext_epgs:
-        ext_epg_dn = ext_epg['l3extInstP']['attributes']['dn']
-        l3out_dn = '/'.join(ext_epg_dn.split('/')[:-1])
-        result = apic.aci_get_mo(l3out_dn, 'l3extLNodeP')
-        l3outs_with_children = result['data']
-        for l3out_with_children in l3outs_with_children:
-            if 'children' in l3out_with_children['l3extOut']:
-                node_profs = l3out_with_children['l3extOut']['children']
-                for node_prof in node_profs:
-                    node_prof_rn = node_prof['l3extLNodeP']['attributes']['rn']
-                    node_prof_dn = l3out_dn + '/' + node_prof_rn
-                    result = apic.aci_get_mo(node_prof_dn, 'l3extRsNodeL3OutAtt')
-                    node_profs_with_children = result['data']
-                    for node_prof_with_children in node_profs_with_children:
-                        l3outattrs = node_prof_with_children['l3extLNodeP']['children']
-                        for l3outattr in l3outattrs:
-                            hlq = l3outattr['l3extRsNodeL3OutAtt']['attributes']['tDn']
-                            if hlq in epg_counts.keys():
-                                epg_counts[hlq] += 1
-                            else:
-                                epg_counts[hlq] = 1
-        for epg_hlq, epg_count in epg_counts.items():
-            pod = epg_hlq.split('/')[1]
-            node = epg_hlq.split('/')[2]
-            elastic_doc = {}
-            elastic_doc['mo'] = 'l3extInstP'
-            elastic_doc['hlq'] = fabric_name + '/' + epg_hlq
-            elastic_doc['pod'] = pod
-            elastic_doc['node'] = node
-            elastic_doc['site'] = apic.site
-            elastic_doc['fabric'] = fabric_name
-            elastic_doc[count_field] = epg_count
-            elastic_docs.append(elastic_doc)
-        if debug:
-            pprint(elastic_docs)
-        apic.disconnect()
-    # Add 'environment' and 'region_name' fields
-    for elastic_doc in elastic_docs:
-        elastic_doc['environment'] = config_data['environment']
-        elastic_doc['region_name'] = config_data['region_name']
+    outcomes = collect_concurrently(fabric_names,
+                                    lambda fabric_name: collect_fabric(config_data, fabric_name, logger, debug),
+                                    max_workers, fabric_timeout, logger,
+                                    label=lambda fabric_name: f'Fabric {fabric_name}')
+    # Merge in inventory order so output does not depend on completion order.
+    for fabric_name, (fabric_docs, fabric_time) in zip(fabric_names, outcomes):
+        if fabric_docs is None:
+            continue
+        logger.info(f'Fabric {fabric_name}: {len(fabric_docs)} documents in {fabric_time:.2f} seconds.')
+        elastic_docs.extend(fabric_docs)
+    # 'environment' and 'region_name' are added by basebeat when POSTing, see envelope_fields.
     return elastic_docs
 
 if __name__ == "__main__":
@@ -599,5 +1207,7 @@ if __name__ == "__main__":
                    'environment': 'engineering',
                    'region_name': 'e-eu1'}
     docs = collect_data(config_data)
-    pprint(docs)
+    # Add the envelope fields, as basebeat does when POSTing.
+    pprint([dict({field: config_data[field] for field in envelope_fields if field in config_data}, **doc)
+            for doc in docs])
 
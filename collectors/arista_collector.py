@@ -2,33 +2,184 @@ import requests
 import urllib3
 import json
 import logging
+import concurrent.futures
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 urllib3.disable_warnings(urllib3.exceptions.InsecurePlatformWarning)
 urllib3.disable_warnings(urllib3.exceptions.SNIMissingWarning)
 
 logger = logging.getLogger(__name__)
+# collect_data() adds the scheduled operations it completed to config_data['ops_completed'].
+reports_ops_completed = True
+# Device sessions used by the eapi_sessions (concurrent) mode, keyed by device ip.
+# The module is loaded once by evobeat, so sessions (TLS connections and login cookies)
+# are re-used across collection cycles.
+device_sessions = {}
+
+def interface_status_doc(device, result):
+    """ Count interface link states from 'show interfaces status' output """
+    connected = notconnected = disabled = err_disabled = 0
+    for interface,intf_info in  result['interfaceStatuses'].items():
+        if intf_info['linkStatus'] == 'connected':
+            connected += 1
+        elif intf_info['linkStatus'] == 'notconnect':
+            notconnected += 1
+        elif intf_info['linkStatus'] == 'disabled':
+            disabled += 1
+        elif 'err' in intf_info['linkStatus']:
+            err_disabled += 1
+    return {'hostname': device, 'up': connected, 'down': notconnected, 'disabled': disabled,
+            'err-disabled': err_disabled}
+
+def device_inventory_doc(device, result):
+    """ Model, serial number and software version from 'show version' output """
+    return {'hostname': device, 'model': result['modelName'], 'serial': result['serialNumber'],
+            'sw_version': result['version']}
+
+# eAPI command and document parser for each operation in an inventory item's op list.
+eapi_ops = {
+    'interface_status': ('show interfaces status', interface_status_doc),
+    'device_inventory': ('show version', device_inventory_doc),
+}
+
+def eapi_payload(op_list):
+    """ Pack the commands of every operation into a single runCmds request """
+    return {
+            "jsonrpc": "2.0",
+            "method": "runCmds",
+            "params": {
+            "version": 1,
+            "cmds": [eapi_ops[op][0] for op in op_list],
+            "format": "json"
+            },
+            "id": "1"
+        }
+
+def eapi_docs(device, op_list, response_data, ops_completed=None):
+    """ Map each runCmds result to the document of its operation, successful operations are
+    added to ops_completed """
+    docs = []
+    if 'error' in response_data:
+        # runCmds stops at the first failing command, results before it are in error data.
+        logger.error(f'{device}: eAPI error {response_data["error"].get("message")}.')
+        results = response_data['error'].get('data', [])
+    else:
+        results = response_data['result']
+    for op, result in zip(op_list, results):
+        if 'errors' in result:
+            logger.error(f'{device}: operation {op} failed: {result["errors"]}.')
+            continue
+        try:
+            docs.append(eapi_ops[op][1](device, result))
+            if ops_completed is not None:
+                ops_completed.append(op)
+        except Exception as e:
+            logger.error(f'{device}: failed to parse operation {op}: {str(e)}.')
+    return docs
+
+def device_op_list(inv_item, ops_skipped=()):
+    """ Operations for an inventory item that are due this cycle, defaults to interface_status """
+    op_list = []
+    for op in inv_item.get('op', ['interface_status']):
+        if op in ops_skipped:
+            continue
+        if op in eapi_ops:
+            op_list.append(op)
+        else:
+            logger.error(f'{inv_item["hostname"]}: unknown operation {op}.')
+    return op_list
+
+def collect_device(inv_item, username, password, ops_skipped=(), ops_completed=None):
+    """ Run the device's operations in one runCmds request using its persistent session """
+    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+    authdata = {'username': username, 'password': password }
+    device = inv_item['hostname']
+    ip = inv_item['ip']
+    url_login = f'https://{ip}/login'
+    url_command = f'https://{ip}/command-api'
+    op_list = device_op_list(inv_item, ops_skipped)
+    if not op_list:
+        return []
+    payload = eapi_payload(op_list)
+    device_session = device_sessions.get(ip)
+    if device_session is None:
+        device_session = requests.Session()
+        device_sessions[ip] = device_session
+    # Log in only when the session does not hold a cookie or the cookie has expired.
+    for attempt in range(2):
+        if not device_session.cookies:
+            try:
+                device_session.post(url_login, data=json.dumps(authdata), headers=headers, verify=False, timeout=3)
+            except Exception as e:
+                logger.error(f'Login to {device} failed: {str(e)}')
+                device_sessions.pop(ip).close()
+                return []
+        try:
+            response = device_session.post(url_command, data=json.dumps(payload), headers=headers,
+                                           verify=False, timeout=5)
+        except Exception as e:
+            logger.error(f'Connection to {device} failed: {str(e)}')
+            device_sessions.pop(ip).close()
+            return []
+        if response.status_code in (401, 403):
+            device_session.cookies.clear()
+            continue
+        break
+    if response.status_code == 200:
+        return eapi_docs(device, op_list, response.json(), ops_completed)
+    logger.error(f'Connection to {device} failed, status code {response.status_code}.')
+    return []
+
+def collect_inventory(network_inventory, username, password, max_concurrency, ops_skipped=(), ops_completed=None):
+    """ Fan out collect_device() to the inventory, at most max_concurrency devices at a time """
+    docs = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [(inv_item, executor.submit(collect_device, inv_item, username, password, ops_skipped,
+                                              ops_completed))
+                   for inv_item in network_inventory]
+        # Requests to a device time out, so every future completes.
+        for inv_item, future in futures:
+            try:
+                docs.extend(future.result())
+            except Exception as e:
+                logger.error(f'Collection from {inv_item["hostname"]} failed: {str(e)}')
+    return docs
+
+def collect_data_concurrent(config_data):
+    network_inventory = config_data.get('inventory')
+    username = config_data.get('network_username')
+    password = config_data.get('network_password')
+    max_concurrency = config_data.get('eapi_max_concurrency', 50)
+    # Close sessions of devices no longer in the inventory.
+    inventory_ips = set(inv_item['ip'] for inv_item in network_inventory)
+    for ip in list(device_sessions):
+        if ip not in inventory_ips:
+            device_sessions.pop(ip).close()
+    return collect_inventory(network_inventory, username, password, max_concurrency,
+                             config_data.get('ops_skipped', []), config_data.get('ops_completed'))
+
 # Collector must contain collect_data function.
 # collect_data() must return a list of documents (dictionaries) to be posted to elastic.
 def collect_data(config_data):
+    # eapi_async is the former name of eapi_sessions, still accepted.
+    if config_data.get('eapi_sessions', config_data.get('eapi_async')):
+        return collect_data_concurrent(config_data)
     network_inventory = config_data.get('inventory')
     username = config_data.get('network_username')
     password = config_data.get('network_password')
 
     authdata = {'username': username, 'password': password }
     headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+    # ops_skipped is set by basebeat when an operation's own interval (op) has not come round yet.
+    ops_skipped = config_data.get('ops_skipped', [])
     docs = []
     for inv_item in network_inventory:
-        # initialise counters
-        connected = 0
-        notconnected = 0
-        disabled = 0
-        err_disabled = 0
         device = inv_item['hostname']
         ip = inv_item['ip']
+        op_list = device_op_list(inv_item, ops_skipped)
+        if not op_list:
+            continue
         url_login = f'https://{ip}/login'
-        # Initialise dictionary
-        doc = {'hostname': device}
         device_session = requests.Session()
         # POST authentication data to login
         try:
@@ -40,17 +191,8 @@ def collect_data(config_data):
             logging.error(str(e))
             device_session.close()
             continue
-        # Set HTTPS payload
-        payload = {
-                    "jsonrpc": "2.0",
-                    "method": "runCmds",
-                    "params": {
-                    "version": 1,
-                    "cmds": [ "show interfaces status" ],
-                    "format": "json"
-                    },
-                    "id": "1"
-                }
+        # Set HTTPS payload, one runCmds request for all operations
+        payload = eapi_payload(op_list)
         url_command = f'https://{ip}/command-api'
         response = device_session.post(url_command, data=json.dumps(payload),
                                                     headers=headers,
@@ -59,21 +201,8 @@ def collect_data(config_data):
         device_session.close()
 
         if response.status_code == 200:
-            for interface,intf_info in  response.json()['result'][0]['interfaceStatuses'].items():
-                if intf_info['linkStatus'] == 'connected':
-                    connected += 1
-                elif intf_info['linkStatus'] == 'notconnect':
-                    notconnected += 1
-                elif intf_info['linkStatus'] == 'disabled':
-                    disabled += 1
-                elif 'err' in intf_info['linkStatus']:
-                    err_disabled += 1
-            doc['up'] = connected
-            doc['down'] = notconnected
-            doc['disabled'] = disabled
-            doc['err-disabled'] = err_disabled
             # append to list of docs
-            docs.append(doc)
+            docs.extend(eapi_docs(device, op_list, response.json(), config_data.get('ops_completed')))
         else:
             logger.error(f'Connection to {device} failed, status code {response.status_code}.')
     return docs
@@ -0,0 +1,67 @@
+import time
+import threading
+
+# Helpers shared by collector modules. evobeat puts the collectors directory on sys.path,
+# so collectors import this module by name.
+
+def collect_concurrently(items, collect, max_workers, timeout, logger, label=str):
+    """ Run collect(item) for every item, each on its own daemon thread, at most max_workers
+    at a time.
+
+    An item still running timeout seconds after it started is abandoned for this cycle: its
+    result is discarded and its place is given to the next item, so a hung item does not hold
+    up the items queued behind it. Returns (result, seconds) for each item in item order.
+    result is None when collect() raised or timed out, seconds is None when the item never
+    started.
+    """
+    lock = threading.Lock()
+    changed = threading.Condition(lock)
+    slots = threading.BoundedSemaphore(max_workers)
+    started = {}
+    closed = set()
+    outcomes = [(None, None)] * len(items)
+
+    def close(index, outcome):
+        # Record an item's outcome and free its slot, once. Called holding lock.
+        if index in closed:
+            return False
+        closed.add(index)
+        outcomes[index] = outcome
+        slots.release()
+        changed.notify_all()
+        return True
+
+    def abandon_overdue():
+        # Called holding lock.
+        time_now = time.time()
+        for index, start_time in started.items():
+            if index not in closed and time_now - start_time > timeout:
+                close(index, (None, time_now - start_time))
+                logger.error(f'{label(items[index])} timed out after {timeout} seconds.')
+
+    def run(index):
+        error = None
+        try:
+            result = collect(items[index])
+        except Exception as collect_error:
+            result, error = None, collect_error
+        with lock:
+            # An abandoned item's late result or error is dropped.
+            if close(index, (result, time.time() - started[index])) and error is not None:
+                logger.error(f'{label(items[index])} failed: {str(error)}')
+
+    for index in range(len(items)):
+        # Wait for a free slot, abandoning overdue items to make room.
+        while not slots.acquire(timeout=1):
+            with lock:
+                abandon_overdue()
+        with lock:
+            started[index] = time.time()
+        threading.Thread(target=run, args=(index,), name=f'collect-{index}', daemon=True).start()
+    with changed:
+        while len(closed) < len(items):
+            changed.wait(timeout=1)
+            abandon_overdue()
+    # Abandoned items are not waited for. Their daemon threads end whenever collect() returns,
+    # a thread that never returns is left behind without holding up later items or cycles.
+    return outcomes
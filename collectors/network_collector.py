@@ -4,6 +4,8 @@ import json
 import os
 import sys
 import time
+import threading
+from collector_utils import collect_concurrently
 
 # The inventory() function is optional. If not present, static inventory must be provided in the config.yaml file.
 # Any valid python object may be returned. It is passed to collector function as config_data["inventory"]
@@ -17,13 +19,126 @@ def inventory(config_data):
 # Collector must contain collect_data function
 # collect_data() must return a list of documents (dictionaries) to be posted to elastic
 
+# collect_data() adds the scheduled operations it completed to config_data["ops_completed"].
+reports_ops_completed = True
+
+class SessionPool():
+    """ Long-lived netmiko sessions keyed by (ip, username, device type).
+
+    The pool is held at module level, evobeat loads the collector module once so sessions
+    survive across collection cycles. Sessions are liveness checked before use, failed
+    connections are retried with exponential backoff and idle sessions are evicted.
+    """
+
+    def __init__(self, **kwargs):
+        self.logger = kwargs["logger"]
+        self.max_sessions = kwargs.get("max_sessions", 100)
+        self.idle_timeout = kwargs.get("idle_timeout", 900)
+        self.backoff = kwargs.get("backoff", 30)
+        self.max_backoff = kwargs.get("max_backoff", 900)
+        self.sessions = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, connect):
+        """ Return a session entry for key, calling connect() to open a new session if required """
+        f_name = sys._getframe().f_code.co_name
+        time_now = time.time()
+        with self.lock:
+            failure = self.failures.get(key)
+            if failure and time_now < failure['retry_time']:
+                self.logger.warning(f'Network Collector ({f_name}) - {key[0]} in backoff for '
+                                    f'{failure["retry_time"] - time_now:.0f} seconds.')
+                return None
+            session = self.sessions.get(key)
+            if session:
+                if session['in_use']:
+                    self.logger.warning(f'Network Collector ({f_name}) - session to {key[0]} still in use.')
+                    return None
+                session['in_use'] = True
+        if session:
+            try:
+                alive = session['shell'].is_alive()
+            except Exception:
+                alive = False
+            if alive:
+                return session
+            self.logger.info(f'Network Collector ({f_name}) - session to {key[0]} is dead, reconnecting.')
+            self.release(session, discard=True)
+        try:
+            shell, prompt = connect()
+        except Exception as error:
+            with self.lock:
+                failure = self.failures.setdefault(key, {'count': 0, 'retry_time': 0})
+                failure['count'] += 1
+                backoff = min(self.backoff * 2 ** (failure['count'] - 1), self.max_backoff)
+                failure['retry_time'] = time.time() + backoff
+            self.logger.error(f'Network Collector ({f_name}) - Failed to connect to device {key[0]}, '
+                              f'retrying in {backoff} seconds.')
+            self.logger.error(str(error))
+            return None
+        session = {'key': key, 'shell': shell, 'prompt': prompt, 'in_use': True, 'pooled': True,
+                   'last_used': time.time()}
+        with self.lock:
+            self.failures.pop(key, None)
+            if len(self.sessions) >= self.max_sessions:
+                # Make room by closing the least recently used idle session.
+                idle = [item for item in self.sessions.values() if not item['in_use']]
+                if idle:
+                    lru = min(idle, key=lambda item: item['last_used'])
+                    del self.sessions[lru['key']]
+                    self.close(lru)
+                else:
+                    session['pooled'] = False
+            if session['pooled']:
+                self.sessions[key] = session
+        return session
+
+    def release(self, session, discard=False):
+        """ Return a session to the pool, closing it if discarded or not pooled """
+        with self.lock:
+            session['in_use'] = False
+            session['last_used'] = time.time()
+            if discard or not session['pooled']:
+                if self.sessions.get(session['key']) is session:
+                    del self.sessions[session['key']]
+            else:
+                return
+        self.close(session)
+
+    def evict_idle(self):
+        """ Close sessions that have not been used for idle_timeout seconds """
+        time_now = time.time()
+        with self.lock:
+            idle = [session for session in self.sessions.values()
+                    if not session['in_use'] and time_now - session['last_used'] > self.idle_timeout]
+            for session in idle:
+                del self.sessions[session['key']]
+        for session in idle:
+            self.logger.info(f'Network Collector - closing idle session to {session["key"][0]}.')
+            self.close(session)
+
+    def close(self, session):
+        try:
+            session['shell'].disconnect()
+        except Exception:
+            pass
+
+# Shared session pool, created by collect_data() when ssh_session_pool is set.
+session_pool = None
+
 class NetCollector():
 
     def __init__(self, **kwargs):
         f_name = sys._getframe().f_code.co_name
         self.connected = False
         self.device_shell = ""
+        self.session = None
+        # Set when an operation fails, its session may hold leftover output.
+        self.op_failed = False
         self.collected_docs = []
+        # Operations completed on this device.
+        self.ops_completed = []
         if kwargs:
             try:
                 self.username = kwargs["username"]
@@ -34,6 +149,8 @@ class NetCollector():
                 self.netmiko_device_type = kwargs["netmiko_device_type"]
                 self.op_list = kwargs["op_list"]
                 self.logger = kwargs["logger"]
+                self.timeout = kwargs.get("timeout", 100)
+                self.pool = kwargs.get("pool")
             
             except Exception:
                 self.logger.error(f'Network Collector ({f_name}) - missing connection parameters.')
@@ -65,22 +182,37 @@ class NetCollector():
         else:
             self.logger.error(f'Network Collector ({f_name}) - missing connection parameters.')
 
+    def ssh_open(self):
+        """ Open a netmiko session, returns (device_shell, prompt) """
+        if self.netmiko_device_type == 'cisco_nxos':
+            global_delay_factor = 3
+        else:
+            global_delay_factor = 1
+
+        device_shell = netmiko.ConnectHandler(device_type='cisco_ios',
+                                              ip=self.ip,
+                                              username=self.username,
+                                              password=self.password,
+                                              global_delay_factor=global_delay_factor,
+                                              timeout=self.timeout)
+
+        prompt = device_shell.find_prompt()
+        device_shell.disable_paging()
+
+        return device_shell, prompt
+
     def ssh_connect(self):
         f_name = sys._getframe().f_code.co_name
+        if self.pool:
+            # Connection errors and backoff are handled by the session pool.
+            self.session = self.pool.get((self.ip, self.username, self.netmiko_device_type), self.ssh_open)
+            if self.session:
+                self.device_shell = self.session['shell']
+                self.prompt = self.session['prompt']
+                self.connected = True
+            return
         try:
-            if self.netmiko_device_type == 'cisco_nxos':
-                global_delay_factor = 3
-            else:
-                global_delay_factor = 1
-            
-            self.device_shell = netmiko.ConnectHandler(device_type='cisco_ios',
-                                                       ip=self.ip,
-                                                       username=self.username,
-                                                       password=self.password,
-                                                       global_delay_factor=global_delay_factor)
-
-            self.prompt = self.device_shell.find_prompt()
-            self.device_shell.disable_paging()
+            self.device_shell, self.prompt = self.ssh_open()
             self.connected = True
 
         except Exception as error:
@@ -92,8 +224,16 @@ class NetCollector():
     def ssh_disconnect(self):
         f_name = sys._getframe().f_code.co_name
         """ Netmiko Disconnect from Device """
+        if self.session:
+            # Pooled sessions stay open for the next collection cycle, unless an operation failed
+            # part way through a command.
+            if self.op_failed:
+                self.logger.warning(f'Network Collector ({f_name}) - operation failed on {self.device}, '
+                                    f'closing its session.')
+            self.pool.release(self.session, discard=self.op_failed)
+            return
         try:
-            self.device_shell
+            self.device_shell.disconnect()
         
         except Exception as error:
             self.logger.error(f'Network Collector ({f_name}) - Failed to disconnect from device {self.device}.')
@@ -164,8 +304,10 @@ class NetCollector():
                                             'ports_util_percent': round(ports_util_percent, ndigits=1),
                                             'ports_up': ports_up})
                 print(self.collected_docs)
+            self.ops_completed.append('port_capacity')
 
         except Exception as error:
+            self.op_failed = True
             self.logger.error(f'Network Collector ({f_name}) - failed to collect and parse data.')
             self.logger.error(str(error))
 
@@ -190,31 +332,75 @@ class NetCollector():
                                             'sw_version': sw_version,
                                             'serial': serial,
                                             'model': model})
+            self.ops_completed.append('device_inventory')
 
         except Exception as error:
+            self.op_failed = True
             self.logger.error(f'Network Collector ({f_name}) - failed to collect and parse data.')
             self.logger.error(str(error))
 
         return   
     
+def collect_device(inv_item, username, password, timeout, logger, pool=None, ops_skipped=(), ops_completed=None):
+    """ Collect from a single inventory item, returns a list of docs """
+    device = inv_item['hostname']
+    # Operations in ops_skipped are not due this cycle.
+    op_list = [op for op in inv_item["op"] if op not in ops_skipped]
+    if inv_item["op"] and not op_list:
+        return []
+    logger.info(f'Network Collector - collecting telemetry from Device {device}.')
+    net_collector = NetCollector(device=device, netmiko_device_type=inv_item["netmiko_device_type"],
+                                 ip=inv_item["ip"], username=username, password=password, site=inv_item["site"],
+                                 op_list=op_list, timeout=timeout, pool=pool,
+                                 logger=logger)
+    if ops_completed is not None:
+        ops_completed.extend(net_collector.ops_completed)
+
+    return net_collector.collected_docs
+
 def collect_data(config_data):
+    global session_pool
     logger = logging.getLogger(config_data.get("args_name"))
     network_collector_docs = []
     network_inventory = config_data["inventory"]
     username = config_data["network_username"]
     password = config_data["network_password"]
-    for inv_item in network_inventory:
+    # max_workers defaults to 1, devices are collected one after another.
+    max_workers = config_data.get("max_workers", 1)
+    # device_timeout (seconds) defaults to 120, a device that takes longer is abandoned for this cycle.
+    device_timeout = config_data.get("device_timeout", 120)
+    # ops_skipped is set by basebeat when an operation's own interval (op) has not come round yet.
+    ops_skipped = config_data.get("ops_skipped", [])
+    # Completed operations are reported to basebeat, an operation completed on any device counts.
+    ops_completed = config_data.get("ops_completed", [])
+    # ssh_session_pool keeps SSH sessions open between collection cycles.
+    if config_data.get("ssh_session_pool"):
+        if session_pool is None:
+            session_pool = SessionPool(logger=logger,
+                                       max_sessions=config_data.get("ssh_pool_max_sessions", 100),
+                                       idle_timeout=config_data.get("ssh_pool_idle_timeout", 900),
+                                       backoff=config_data.get("ssh_pool_backoff", 30),
+                                       max_backoff=config_data.get("ssh_pool_max_backoff", 900))
+        session_pool.evict_idle()
+    start_time = time.time()
+    device_times = {}
+    outcomes = collect_concurrently(network_inventory,
+                                    lambda inv_item: collect_device(inv_item, username, password, device_timeout,
+                                                                    logger, session_pool, ops_skipped, ops_completed),
+                                    max_workers, device_timeout, logger,
+                                    label=lambda inv_item: f'Network Collector - Device {inv_item["hostname"]}')
+    for inv_item, (collected_docs, device_time) in zip(network_inventory, outcomes):
         device = inv_item['hostname']
-        netmiko_device_type = inv_item["netmiko_device_type"]
-        ip = inv_item["ip"]
-        site = inv_item["site"]
-        op_list = inv_item["op"]
-        logger.info(f'Network Collector - collecting telemetry from Device {device}.')
-        collected_docs = NetCollector(device=device, netmiko_device_type=netmiko_device_type,
-                                      ip=ip, username=username, password=password, site=site,
-                                      op_list=op_list, logger=logger).collected_docs
-
-        if collected_docs:
-            network_collector_docs += collected_docs
+        if device_time is not None:
+            device_times[device] = device_time
+        if collected_docs is None:
+            continue
+        logger.info(f'Network Collector - Device {device}: {len(collected_docs)} documents '
+                    f'in {device_time:.2f} seconds.')
+        network_collector_docs += collected_docs
+    slowest = sorted(device_times.items(), key=lambda item: item[1], reverse=True)[:5]
+    slowest_msg = ', '.join(f'{device} ({device_time:.2f}s)' for device, device_time in slowest)
+    logger.info(f'Network Collector - collected {len(device_times)} devices in {time.time() - start_time:.2f} '
+                f'seconds with {max_workers} workers. Slowest: {slowest_msg}.')
 
     return network_collector_docs
@@ -3,7 +3,7 @@ import logging
 
 logger = logging.getLogger(__name__)
 # Collector must contain collect_data function.
-# collect_data() must return a list of documents (dictionaries) to be posted to elastic.
+# collect_data() must return a list (or generator) of documents (dictionaries) to be posted to elastic.
 def collect_data(config_data):
     docs = []
     inventory = config_data.get('inventory')
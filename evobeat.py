@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import evobeatd
 import argparse
+import os
 from pprint import pprint as pprint
 
 parser = argparse.ArgumentParser(description='Collect elastic telemetry.')
@@ -13,36 +14,61 @@ parser_test.add_argument('--name', help='Collector name, configuration must be s
 parser_test.add_argument('--debug', help='Print debug messages and collected data.', action='store_true')
 # run
 parser_run = subparsers.add_parser('run', help='Start the collector and POST data.')
-parser_run.add_argument('--name', help='Collector name, configuration must be stored in config/name.yaml.', required=True)
+parser_run_names = parser_run.add_mutually_exclusive_group(required=True)
+parser_run_names.add_argument('--name', help='Collector name, configuration must be stored in config/name.yaml.')
+parser_run_names.add_argument('--names', help='Comma separated collector names, run together in one process.')
+parser_run_names.add_argument('--config_dir', help='Run every YAML configuration in this directory in one process.')
 parser_run.add_argument('--run_once', help='Collect and post once.', action='store_true')
 parser_run.add_argument('--debug', help='Print debug messages and collected data.', action='store_true')
-# Check supplied args
-args = parser.parse_args()
-if args.subcommand == 'version':
-    print('INFO: Version 1.0.1')
-elif args.subcommand == 'test':
-    try:
-        beat = evobeatd.basebeat(name=args.name, mode='test')
-    except Exception as error:
-        print(str(error))
-    else:
-        print('INFO: Configuration OK.')
+
+
+def main():
+    # Check supplied args
+    args = parser.parse_args()
+    if args.subcommand == 'version':
+        print('INFO: Version 1.0.1')
+    elif args.subcommand == 'test':
+        try:
+            beat = evobeatd.basebeat(name=args.name, mode='test')
+        except Exception as error:
+            print(str(error))
+        else:
+            print('INFO: Configuration OK.')
+            if args.debug:
+                beat.debug = True
+                beat.config_data['debug'] = None
+            # Run collector once
+            print('INFO: Collecting data.')
+            # Show the documents as they would be indexed, including the envelope fields
+            beat.elastic_docs = beat.enveloped_docs(beat.collector_module.collect_data(beat.config_data))
+            pprint(beat.elastic_docs)
+    elif args.subcommand == 'run' and (args.names or args.config_dir):
+        # Run several collectors in one process
+        if args.names:
+            configs = [(name.strip(), None) for name in args.names.split(',') if name.strip()]
+        else:
+            configs = [(os.path.splitext(file_name)[0], os.path.join(args.config_dir, file_name))
+                       for file_name in sorted(os.listdir(args.config_dir))
+                       if file_name.endswith('.yaml') or file_name.endswith('.yml')]
+        supervisor = evobeatd.Supervisor(configs, mode='run', debug=args.debug)
+        if args.run_once:
+            supervisor.run_once()
+        else:
+            supervisor.run()
+    elif args.subcommand == 'run':
+        beat = evobeatd.basebeat(name=args.name, mode='run')
         if args.debug:
             beat.debug = True
             beat.config_data['debug'] = None
-        # Run collector once
-        print('INFO: Collecting data.')
-        beat.elastic_docs = beat.collector_module.collect_data(beat.config_data)
-        pprint(beat.elastic_docs)
-elif args.subcommand == 'run':
-    beat = evobeatd.basebeat(name=args.name, mode='run')
-    if args.debug:
-        beat.debug = True
-        beat.config_data['debug'] = None
-    if args.run_once:
-        # Collect data and POST once
-        beat.elastic_docs = beat.collector_module.collect_data(beat.config_data)
-        beat.post()
-    else:
-        # Run at times set by interval
-        beat.run()
+        if args.run_once:
+            # Collect data and POST once
+            beat.elastic_docs = beat.collector_module.collect_data(beat.config_data)
+            beat.post()
+        else:
+            # Run at times set by interval
+            beat.run()
+
+
+# Process pool workers (process_workers) import this module, only run when executed.
+if __name__ == '__main__':
+    main()
@@ -11,12 +11,492 @@ import logging
 import importlib
 import importlib.util
 import traceback
+import hashlib
+import collections
+import threading
+import queue
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import random
+import re
+import socket
+import atexit
 from elasticsearch import Elasticsearch, helpers, RequestsHttpConnection
+from elasticsearch.serializer import JSONSerializer
 from pprint import pprint
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from logging import StreamHandler
 
 
+class ChangeCache(object):
+    """ Content hashes of POSTed documents, keyed by a configurable document identity.
+
+    Documents whose content is unchanged since they were last POSTed are skipped, except
+    on snapshot cycles (every snapshot_cycles cycles) when everything is POSTed. Documents
+    without all of the key fields are always POSTed. The least recently seen keys are
+    evicted once max_entries is reached.
+    """
+
+    def __init__(self, key_fields, max_entries=100000, snapshot_cycles=10):
+        self.key_fields = key_fields
+        self.max_entries = max_entries
+        self.snapshot_cycles = snapshot_cycles
+        self.hashes = collections.OrderedDict()
+        self.cycles = 0
+        self.cycle_time = None
+        self.snapshot = True
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Keys seen in the current batch, a key seen twice means key_fields do not identify
+        # documents, which then overwrite each other's hash and are never skipped.
+        self.batch_keys = set()
+        self.duplicates = 0
+        self.duplicate_key = None
+
+    def start_cycle(self, cycle_time=None):
+        # POSTs with the same cycle_time (e.g. staggered slots of one interval) are one cycle.
+        if cycle_time is None or cycle_time != self.cycle_time:
+            self.snapshot = self.cycles % self.snapshot_cycles == 0
+            self.cycles += 1
+            self.cycle_time = cycle_time
+        self.hits = self.misses = self.evictions = 0
+        self.batch_keys = set()
+        self.duplicates = 0
+        self.duplicate_key = None
+
+    def clear(self):
+        # Forget all hashes, used when a POST fails so nothing is wrongly skipped next cycle.
+        self.hashes.clear()
+
+    def forget(self, docs):
+        # Forget the hashes of documents that were not POSTed (failed or spooled), so they
+        # are not skipped next cycle.
+        for doc in docs:
+            try:
+                key = tuple(doc[field] for field in self.key_fields)
+            except KeyError:
+                continue
+            self.hashes.pop(key, None)
+
+    def filter(self, docs):
+        for doc in docs:
+            try:
+                key = tuple(doc[field] for field in self.key_fields)
+            except KeyError:
+                yield doc
+                continue
+            if key in self.batch_keys:
+                self.duplicates += 1
+                self.duplicate_key = key
+            else:
+                self.batch_keys.add(key)
+            # @timestamp changes every cycle, so it is not part of the document content.
+            content = {field: value for field, value in doc.items() if field != '@timestamp'}
+            digest = hashlib.md5(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            if self.hashes.get(key) == digest:
+                self.hits += 1
+                self.hashes.move_to_end(key)
+                if not self.snapshot:
+                    continue
+            else:
+                self.misses += 1
+                self.hashes[key] = digest
+                self.hashes.move_to_end(key)
+                while len(self.hashes) > self.max_entries:
+                    self.hashes.popitem(last=False)
+                    self.evictions += 1
+            yield doc
+
+
+class Envelope(object):
+    """ Fields shared by every document in a batch, such as @timestamp and static tags.
+
+    The fields are serialized once per batch and attached to each document as it is
+    serialized, so documents are never modified. Fields already present in a document
+    are left as they are.
+    """
+
+    def __init__(self, fields, default=None):
+        self.fields = fields
+        self.default = default
+        self.fragment = self.serialize(fields)
+
+    def serialize(self, fields):
+        # JSON object members without the enclosing braces.
+        return json.dumps(fields, default=self.default, separators=(',', ':'))[1:-1]
+
+    def dumps(self, doc):
+        data = json.dumps(doc, default=self.default, separators=(',', ':'))
+        fragment = self.fragment
+        if any(field in doc for field in self.fields):
+            fragment = self.serialize({field: value for field, value in self.fields.items() if field not in doc})
+        if not fragment:
+            return data
+        if data == '{}':
+            return '{' + fragment + '}'
+        return data[:-1] + ',' + fragment + '}'
+
+
+class SerializedDocs(object):
+    """ Documents already serialized by process pool workers, with their envelope, as one
+    NDJSON bytes blob per work unit.
+    """
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def __len__(self):
+        return sum(blob.count(b'\n') for blob in self.blobs)
+
+    def lines(self):
+        for blob in self.blobs:
+            for line in blob.split(b'\n'):
+                if line:
+                    yield line.decode('utf-8')
+
+
+# Collector modules loaded in process pool workers, by module path.
+worker_modules = {}
+# Set in a process pool worker once its log records are sent to the beat.
+worker_log_queue = None
+
+
+def load_collector_module(collector_module_path):
+    # Load a collector module from its file. The collectors directory is put on sys.path, so
+    # collectors can import the helpers shared between them (collector_utils).
+    collectors_dir = os.path.dirname(collector_module_path)
+    if collectors_dir not in sys.path:
+        sys.path.append(collectors_dir)
+    collector_module_name = os.path.splitext(os.path.basename(collector_module_path))[0]
+    collector_module_spec = importlib.util.spec_from_file_location(collector_module_name, collector_module_path)
+    collector_module = importlib.util.module_from_spec(collector_module_spec)
+    collector_module_spec.loader.exec_module(collector_module)
+    return collector_module
+
+
+def worker_logging(log_queue, logger_name, level):
+    # Send a process pool worker's log records to the beat's handlers through log_queue. Done
+    # by the first work unit, ProcessPoolExecutor has no initializer before Python 3.7.
+    global worker_log_queue
+    if worker_log_queue is not None:
+        return
+    worker_log_queue = log_queue
+    logging.getLogger(logger_name).setLevel(level)
+    logging.getLogger().addHandler(QueueHandler(log_queue))
+
+
+def collect_work_unit(collector_module_path, config_data, envelope_fields, log_queue, logger_name, level):
+    # Runs collect_data() for one work unit in a process pool worker. Documents are returned
+    # as NDJSON bytes, so the parent only has to POST them.
+    worker_logging(log_queue, logger_name, level)
+    if collector_module_path not in worker_modules:
+        worker_modules[collector_module_path] = load_collector_module(collector_module_path)
+    docs = worker_modules[collector_module_path].collect_data(config_data)
+    envelope = Envelope(envelope_fields, default=JSONSerializer().default)
+    blob = b''.join(envelope.dumps(doc).encode('utf-8') + b'\n' for doc in docs)
+    # Operations the work unit completed, see reports_ops_completed.
+    return blob, config_data.get('ops_completed', [])
+
+
+class DurationEstimator(object):
+    """ Rolling estimate of how long a collection takes.
+
+    The estimate is the larger of an EWMA and the p95 of the last window samples, plus a
+    fixed margin in seconds. Until the first sample it is the initial value.
+    """
+
+    def __init__(self, initial, alpha=0.3, window=20, margin=1):
+        self.initial = initial
+        self.alpha = alpha
+        self.margin = margin
+        self.ewma = None
+        self.samples = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, duration):
+        with self.lock:
+            self.samples.append(duration)
+            if self.ewma is None:
+                self.ewma = duration
+            else:
+                self.ewma = self.alpha * duration + (1 - self.alpha) * self.ewma
+
+    def p95(self):
+        with self.lock:
+            if not self.samples:
+                return None
+            samples = sorted(self.samples)
+            return samples[max(0, int(len(samples) * 0.95 + 0.5) - 1)]
+
+    def estimate(self):
+        p95 = self.p95()
+        with self.lock:
+            if self.ewma is None:
+                return self.initial
+            return max(self.ewma, p95) + self.margin
+
+
+class BatchPoster(threading.Thread):
+    """ Drains collected batches from a queue and POSTs each one at its post time.
+
+    Batches are (beat, post_time, docs) tuples, so the next cycle can be collected while
+    the previous batch is still being POSTed. Each beat holds one of its batch_slots for
+    every batch in the queue, which bounds the batches waiting per beat.
+    """
+
+    def __init__(self, batch_queue, name='batch-poster'):
+        super().__init__(name=name, daemon=True)
+        self.batch_queue = batch_queue
+
+    def run(self):
+        while True:
+            beat, post_time, docs = self.batch_queue.get()
+            try:
+                seconds_until_post = post_time - time.time()
+                if seconds_until_post > 0:
+                    time.sleep(seconds_until_post)
+                elif seconds_until_post < -1:
+                    msg = f'{self.name}: POST for {datetime.datetime.fromtimestamp(post_time)} ' + \
+                          f'is {-seconds_until_post:.2f} seconds late.'
+                    beat.logger.warning(msg)
+                beat.post(docs, post_time=post_time)
+            except Exception:
+                beat.logger.error(traceback.format_exc())
+            finally:
+                beat.batch_slots.release()
+                self.batch_queue.task_done()
+
+
+class DiskSpool(object):
+    """ Append-only on-disk spool of bulk (action, data) pairs that could not be POSTed.
+
+    Pairs are written as bulk NDJSON lines to numbered segment files, rotated at
+    segment_bytes. The oldest segments are dropped once the spool is over max_bytes.
+    The replay position is kept in an offset file, so a restart resumes where it left off.
+    """
+
+    def __init__(self, path, logger, segment_bytes=64*1024*1024, max_bytes=1024*1024*1024):
+        self.path = path
+        self.logger = logger
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.offset_file = os.path.join(path, 'offset')
+        self.segments = sorted(int(file_name.split('.')[0]) for file_name in os.listdir(path)
+                               if file_name.endswith('.ndjson'))
+        try:
+            with open(self.offset_file, 'r') as offset_file:
+                offset = json.load(offset_file)
+            self.read_segment = offset['segment']
+            self.read_offset = offset['offset']
+        except (FileNotFoundError, ValueError, KeyError):
+            self.read_segment = self.segments[0] if self.segments else 1
+            self.read_offset = 0
+        # Always append to a new segment, a previous run may have left a partial line.
+        self.write_segment = self.segments[-1] + 1 if self.segments else 1
+        self.write_file = None
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, f'{segment:012d}.ndjson')
+
+    def save_offset(self):
+        offset_tmp = self.offset_file + '.tmp'
+        with open(offset_tmp, 'w') as offset_file:
+            json.dump({'segment': self.read_segment, 'offset': self.read_offset}, offset_file)
+        os.replace(offset_tmp, self.offset_file)
+
+    def depth(self):
+        # Returns (bytes, segments) waiting to be replayed.
+        with self.lock:
+            backlog = sum(os.path.getsize(self.segment_path(segment)) for segment in self.segments)
+            if self.read_segment in self.segments:
+                backlog -= self.read_offset
+            return backlog, len(self.segments)
+
+    def append(self, pairs):
+        with self.lock:
+            if self.write_file is None:
+                self.write_file = open(self.segment_path(self.write_segment), 'ab')
+                self.segments.append(self.write_segment)
+            action_lines = {}
+            for action, data in pairs:
+                if id(action) not in action_lines:
+                    action_lines[id(action)] = json.dumps(action, separators=(',', ':')).encode('utf-8')
+                self.write_file.write(action_lines[id(action)] + b'\n' + data.encode('utf-8') + b'\n')
+            self.write_file.flush()
+            os.fsync(self.write_file.fileno())
+            if self.write_file.tell() >= self.segment_bytes:
+                self.write_file.close()
+                self.write_file = None
+                self.write_segment += 1
+            # Drop the oldest segments when the spool is full.
+            backlog = sum(os.path.getsize(self.segment_path(segment)) for segment in self.segments)
+            while backlog > self.max_bytes and len(self.segments) > 1:
+                segment = self.segments.pop(0)
+                segment_bytes = os.path.getsize(self.segment_path(segment))
+                os.remove(self.segment_path(segment))
+                backlog -= segment_bytes
+                msg = f'Spool {self.path} is full, dropped segment {segment} ({segment_bytes} bytes).'
+                self.logger.warning(msg)
+                if segment >= self.read_segment:
+                    self.read_segment = self.segments[0]
+                    self.read_offset = 0
+                    self.save_offset()
+
+    def read(self, max_pairs):
+        # Returns up to max_pairs pairs from the replay position, and the position after
+        # them. Pass the position to commit() once the pairs have been POSTed.
+        with self.lock:
+            pairs = []
+            segment = self.read_segment
+            offset = self.read_offset
+            while len(pairs) < max_pairs:
+                if segment not in self.segments:
+                    later_segments = [later for later in self.segments if later > segment]
+                    if not later_segments:
+                        break
+                    segment = later_segments[0]
+                    offset = 0
+                with open(self.segment_path(segment), 'rb') as segment_file:
+                    segment_file.seek(offset)
+                    while len(pairs) < max_pairs:
+                        action_line = segment_file.readline()
+                        data_line = segment_file.readline()
+                        # End of the segment, or a partial line from an interrupted write.
+                        if not data_line.endswith(b'\n'):
+                            break
+                        pairs.append((json.loads(action_line), data_line[:-1].decode('utf-8')))
+                        offset = segment_file.tell()
+                if len(pairs) < max_pairs:
+                    if segment == self.write_segment and self.write_file is not None:
+                        break
+                    # Segment is finished, continue with the next one.
+                    segment += 1
+                    offset = 0
+            return pairs, (segment, offset)
+
+    def commit(self, position):
+        # Advance the replay position, removing segments that have been replayed.
+        with self.lock:
+            segment, offset = position
+            for old_segment in [old for old in self.segments if old < segment]:
+                self.segments.remove(old_segment)
+                os.remove(self.segment_path(old_segment))
+            self.read_segment = segment
+            self.read_offset = offset
+            self.save_offset()
+
+
+class SpoolReplayer(threading.Thread):
+    """ Replays spooled documents in order once elasticsearch is reachable, at no more
+    than spool_replay_rate documents per second.
+    """
+
+    def __init__(self, beat):
+        super().__init__(name=f'{beat.name}-spool', daemon=True)
+        self.beat = beat
+
+    def run(self):
+        beat = self.beat
+        # Pairs that failed to replay and the spool position after them. They are retried
+        # before anything later in the spool, which is only committed once they are POSTed.
+        retry = None
+        while True:
+            try:
+                if retry:
+                    pairs, position = retry
+                else:
+                    pairs, position = beat.spool.read(beat.elastic_chunk_size)
+                if not pairs or not beat.es.ping(request_timeout=1):
+                    time.sleep(5)
+                    continue
+                start_replay_time = time.time()
+                result = beat.post_chunk('spool', pairs)
+                if result['failed_pairs']:
+                    retry = (result['failed_pairs'], position)
+                else:
+                    retry = None
+                    beat.spool.commit(position)
+                backlog, segments = beat.spool.depth()
+                msg = f'{self.name}: Replayed {result["success"]} spooled documents, ' + \
+                      f'{len(result["failed_pairs"])} to retry, backlog {backlog} bytes in {segments} segments.'
+                beat.logger.info(msg)
+                # Rate limit replay to spool_replay_rate documents per second.
+                seconds_to_sleep = len(pairs) / beat.spool_replay_rate - (time.time() - start_replay_time)
+                if seconds_to_sleep > 0:
+                    time.sleep(seconds_to_sleep)
+            except Exception:
+                beat.logger.error(traceback.format_exc())
+                time.sleep(5)
+
+
+def inventory_key(item):
+    # Identity of a list inventory item for sharding: its hostname, address or ip,
+    # otherwise its content.
+    if isinstance(item, dict):
+        for field in ['hostname', 'address', 'ip']:
+            if item.get(field):
+                return str(item[field])
+    return json.dumps(item, sort_keys=True, default=str)
+
+
+def rendezvous_shard(key, shard_count):
+    # Rendezvous (highest random weight) hashing, each key belongs to the shard with the
+    # highest hash of shard and key. Adding a shard only moves about 1/shard_count of the keys.
+    return max(range(shard_count), key=lambda shard: hashlib.md5(f'{shard}:{key}'.encode('utf-8')).digest())
+
+
+def select_inventory(inventory, select):
+    # Inventory items whose key passes select(key), in inventory order. A dictionary inventory
+    # (e.g. ACI fabrics) is selected by key, a list inventory by inventory_key().
+    if isinstance(inventory, dict):
+        return {key: value for key, value in inventory.items() if select(str(key))}
+    if isinstance(inventory, list):
+        return [item for item in inventory if select(inventory_key(item))]
+    return inventory
+
+
+def shard_inventory(inventory, shard_index, shard_count):
+    # Inventory items belonging to shard_index.
+    return select_inventory(inventory, lambda key: rendezvous_shard(key, shard_count) == shard_index)
+
+
+def stagger_slot(key, slot_count):
+    # Slot within the interval for an inventory item. Salted so that it does not follow
+    # the shard assignment, which would leave most slots of a replica empty.
+    return int(hashlib.md5(f'stagger:{key}'.encode('utf-8')).hexdigest(), 16) % slot_count
+
+
+def slot_inventory(inventory, slot, slot_count):
+    # Inventory items polled in slot.
+    return select_inventory(inventory, lambda key: stagger_slot(key, slot_count) == slot)
+
+
+def worker_lane(key, lane_count):
+    # Worker process for an inventory item. Salted like stagger_slot().
+    return int(hashlib.md5(f'worker:{key}'.encode('utf-8')).hexdigest(), 16) % lane_count
+
+
+def work_unit_lane(work_unit, lane_count):
+    # Worker process for a work unit, by the key of its first inventory item. The same
+    # inventory goes to the same worker every cycle, so collector module state (sessions,
+    # subscriptions, caches) is held by one worker only.
+    inventory = work_unit.get('inventory')
+    if isinstance(inventory, dict) and inventory:
+        return worker_lane(str(next(iter(inventory))), lane_count)
+    if isinstance(inventory, list) and inventory:
+        return worker_lane(inventory_key(inventory[0]), lane_count)
+    return 0
+
+
+# Elasticsearch clients shared by beats with the same connection parameters.
+elastic_clients = {}
+elastic_clients_lock = threading.Lock()
+
+
 class basebeat(object):
 
     def __init__(self, **kwargs):
@@ -28,7 +508,8 @@ class basebeat(object):
         if kwargs:
             self.name = kwargs['name']
             self.mode = kwargs['mode']
-            self.yaml = self.path + '/configs/' + self.name + '.yaml'
+            # yaml defaults to configs/{name}.yaml
+            self.yaml = kwargs.get('yaml') or self.path + '/configs/' + self.name + '.yaml'
         try:
             with open(self.yaml, 'r') as input_file:
                 self.config_data = yaml.full_load(input_file)
@@ -48,13 +529,8 @@ class basebeat(object):
             self.elastic_password = self.config_data['elastic_password']
             # Load the collector module
             collector_module_name = self.config_data['collector_module']
-            collector_module_path = os.path.join(self.path, 'collectors', collector_module_name) + '.py'
-            # Get the module spec
-            collector_module_spec = importlib.util.spec_from_file_location(collector_module_name, collector_module_path)
-            # Create module from spec
-            self.collector_module = importlib.util.module_from_spec(collector_module_spec)
-            # Load the module
-            collector_module_spec.loader.exec_module(self.collector_module)
+            self.collector_module_path = os.path.join(self.path, 'collectors', collector_module_name) + '.py'
+            self.collector_module = load_collector_module(self.collector_module_path)
             # Test for collect_data() function in collector_module
             if not hasattr(self.collector_module, 'collect_data'):
                 sys.exit(f'ERROR: Module {collector_module_name} doe not have collect_data() function')
@@ -102,6 +578,154 @@ class basebeat(object):
             log_file = self.config_data['log_file']
         else:
             log_file = self.path + '/logs/' + self.name + '.log'
+        # post_queue_size defaults to 2 collected batches waiting to be POSTed
+        if 'post_queue_size' in self.config_data:
+            if isinstance(self.config_data['post_queue_size'], int) and self.config_data['post_queue_size'] > 0:
+                self.post_queue_size = self.config_data['post_queue_size']
+            else:
+                sys.exit('ERROR: post_queue_size must be a positive integer.')
+        else:
+            self.post_queue_size = 2
+        # processing_time is the initial collection lead, defaults to 5 seconds. The lead
+        # then follows the measured collection time plus processing_time_margin (default 1).
+        processing_time = self.config_data.get('processing_time', 5)
+        processing_time_margin = self.config_data.get('processing_time_margin', 1)
+        if not isinstance(processing_time, (int, float)) or processing_time < 0:
+            sys.exit('ERROR: processing_time must be a positive number of seconds.')
+        if not isinstance(processing_time_margin, (int, float)) or processing_time_margin < 0:
+            sys.exit('ERROR: processing_time_margin must be a positive number of seconds.')
+        self.collect_duration = DurationEstimator(processing_time, margin=processing_time_margin)
+        # elastic_chunk_size defaults to 500 documents per bulk request
+        if 'elastic_chunk_size' in self.config_data:
+            if isinstance(self.config_data['elastic_chunk_size'], int) and self.config_data['elastic_chunk_size'] > 0:
+                self.elastic_chunk_size = self.config_data['elastic_chunk_size']
+            else:
+                sys.exit('ERROR: elastic_chunk_size must be a positive integer.')
+        else:
+            self.elastic_chunk_size = 500
+        # elastic_max_chunk_bytes defaults to 100MB per bulk request
+        if 'elastic_max_chunk_bytes' in self.config_data:
+            if isinstance(self.config_data['elastic_max_chunk_bytes'], int) and self.config_data['elastic_max_chunk_bytes'] > 0:
+                self.elastic_max_chunk_bytes = self.config_data['elastic_max_chunk_bytes']
+            else:
+                sys.exit('ERROR: elastic_max_chunk_bytes must be a positive integer.')
+        else:
+            self.elastic_max_chunk_bytes = 100 * 1024 * 1024
+        # elastic_bulk_threads defaults to 1 bulk request at a time
+        if 'elastic_bulk_threads' in self.config_data:
+            if isinstance(self.config_data['elastic_bulk_threads'], int) and self.config_data['elastic_bulk_threads'] > 0:
+                self.elastic_bulk_threads = self.config_data['elastic_bulk_threads']
+            else:
+                sys.exit('ERROR: elastic_bulk_threads must be a positive integer.')
+        else:
+            self.elastic_bulk_threads = 1
+        # elastic_max_retries defaults to 5 retries of documents refused with 429 or 5xx
+        if 'elastic_max_retries' in self.config_data:
+            if isinstance(self.config_data['elastic_max_retries'], int) and self.config_data['elastic_max_retries'] >= 0:
+                self.elastic_max_retries = self.config_data['elastic_max_retries']
+            else:
+                sys.exit('ERROR: elastic_max_retries must be zero or a positive integer.')
+        else:
+            self.elastic_max_retries = 5
+        # elastic_initial_backoff defaults to 2 seconds, doubled on each retry up to
+        # elastic_max_backoff (default 60 seconds)
+        self.elastic_initial_backoff = self.config_data.get('elastic_initial_backoff', 2)
+        self.elastic_max_backoff = self.config_data.get('elastic_max_backoff', 60)
+        if not isinstance(self.elastic_initial_backoff, (int, float)) or self.elastic_initial_backoff <= 0:
+            sys.exit('ERROR: elastic_initial_backoff must be a positive number of seconds.')
+        if not isinstance(self.elastic_max_backoff, (int, float)) or self.elastic_max_backoff <= 0:
+            sys.exit('ERROR: elastic_max_backoff must be a positive number of seconds.')
+        # spool enables the on-disk spool of documents that could not be POSTed, defaults to False
+        if 'spool' in self.config_data:
+            if isinstance(self.config_data['spool'], bool):
+                spool = self.config_data['spool']
+            else:
+                sys.exit('ERROR: spool must be True or False.')
+        else:
+            spool = False
+        # spool_dir defaults to logs/spool/{name}
+        spool_dir = self.config_data.get('spool_dir', self.path + '/logs/spool/' + self.name)
+        # spool_max_bytes defaults to 1GB, spool_segment_bytes defaults to 64MB
+        spool_max_bytes = self.config_data.get('spool_max_bytes', 1024 * 1024 * 1024)
+        spool_segment_bytes = self.config_data.get('spool_segment_bytes', 64 * 1024 * 1024)
+        if not isinstance(spool_max_bytes, int) or spool_max_bytes < 1:
+            sys.exit('ERROR: spool_max_bytes must be a positive integer.')
+        if not isinstance(spool_segment_bytes, int) or spool_segment_bytes < 1:
+            sys.exit('ERROR: spool_segment_bytes must be a positive integer.')
+        # spool_replay_rate defaults to 1000 documents per second
+        self.spool_replay_rate = self.config_data.get('spool_replay_rate', 1000)
+        if not isinstance(self.spool_replay_rate, (int, float)) or self.spool_replay_rate <= 0:
+            sys.exit('ERROR: spool_replay_rate must be a positive number.')
+        # elastic_static_fields are added to every document, defaults to none
+        if 'elastic_static_fields' in self.config_data:
+            if isinstance(self.config_data['elastic_static_fields'], dict):
+                self.static_fields = dict(self.config_data['elastic_static_fields'])
+            else:
+                sys.exit('ERROR: elastic_static_fields must be a dictionary of field names and values.')
+        else:
+            self.static_fields = {}
+        # Collector modules can name configuration parameters to add to every document (envelope_fields)
+        for field in getattr(self.collector_module, 'envelope_fields', []):
+            if field not in self.config_data:
+                sys.exit(f'ERROR: Configuration parameter {field} not found in {self.yaml}.')
+            self.static_fields[field] = self.config_data[field]
+        # op sets intervals for individual collector operations, e.g. {device_inventory: 3600}.
+        # Operations not listed run every interval.
+        if 'op' in self.config_data:
+            op_intervals = self.config_data['op']
+            if not isinstance(op_intervals, dict):
+                sys.exit('ERROR: op must be a dictionary of operation names and intervals.')
+            for op, op_interval in op_intervals.items():
+                if not isinstance(op_interval, int) or op_interval < self.interval or op_interval % self.interval:
+                    sys.exit(f'ERROR: op {op} interval must be a multiple of interval ({self.interval}).')
+            self.op_intervals = op_intervals
+        else:
+            self.op_intervals = {}
+        # Last successful run of each scheduled operation, per stagger slot (slot 0 when not staggered).
+        self.ops_last = {}
+        # process_workers enables collection in a pool of worker processes, not enabled by default
+        if 'process_workers' in self.config_data:
+            if isinstance(self.config_data['process_workers'], int) and self.config_data['process_workers'] >= 0:
+                self.process_workers = self.config_data['process_workers']
+            else:
+                sys.exit('ERROR: process_workers must be zero or a positive integer.')
+        else:
+            self.process_workers = 0
+        # Single process pools by stagger slot and worker lane, see work_unit_lane(). Each slot
+        # has its own workers, so slots collected at the same time do not share them.
+        self.process_pools = {}
+        self.process_lock = threading.Lock()
+        # Workers' log records, passed to this beat's handlers by log_listener.
+        self.log_manager = None
+        self.log_queue = None
+        self.log_listener = None
+        # stagger_slots spreads the inventory over that many slots of the interval, not enabled by default
+        if 'stagger_slots' in self.config_data:
+            if isinstance(self.config_data['stagger_slots'], int) and self.config_data['stagger_slots'] >= 1:
+                self.stagger_slots = self.config_data['stagger_slots']
+            else:
+                sys.exit('ERROR: stagger_slots must be a positive integer.')
+            if self.stagger_slots > 1 and not isinstance(self.config_data.get('inventory'), (dict, list)):
+                sys.exit('ERROR: stagger_slots requires a list or dictionary inventory.')
+        else:
+            self.stagger_slots = 1
+        # change_cache_fields enables skipping of unchanged documents, not enabled by default
+        if 'change_cache_fields' in self.config_data:
+            change_cache_fields = self.config_data['change_cache_fields']
+            if not isinstance(change_cache_fields, list) or not change_cache_fields:
+                sys.exit('ERROR: change_cache_fields must be a list of document field names.')
+            # change_cache_max_entries defaults to 100000
+            change_cache_max_entries = self.config_data.get('change_cache_max_entries', 100000)
+            # change_cache_snapshot_cycles defaults to 10, all documents are POSTed every 10 cycles
+            change_cache_snapshot_cycles = self.config_data.get('change_cache_snapshot_cycles', 10)
+            if not isinstance(change_cache_max_entries, int) or change_cache_max_entries < 1:
+                sys.exit('ERROR: change_cache_max_entries must be a positive integer.')
+            if not isinstance(change_cache_snapshot_cycles, int) or change_cache_snapshot_cycles < 1:
+                sys.exit('ERROR: change_cache_snapshot_cycles must be a positive integer.')
+            self.change_cache = ChangeCache(change_cache_fields, max_entries=change_cache_max_entries,
+                                            snapshot_cycles=change_cache_snapshot_cycles)
+        else:
+            self.change_cache = None
         # Check for collector_vault_path
         if 'collector_vault_path' in self.config_data:
             self.collector_vault_path = self.config_data['collector_vault_path']
@@ -122,8 +746,56 @@ class basebeat(object):
             self.logger.addHandler(handler)
         except Exception as error:
             sys.exit('ERROR: Failed to open log file {}.'.format(log_file))
+        # Collect only this replica's shard of the inventory. The replica count comes from
+        # EVOBEAT_SHARD_COUNT (or shard_count), the index from EVOBEAT_SHARD_INDEX or the
+        # StatefulSet ordinal at the end of the hostname.
+        try:
+            self.shard_count = int(os.environ.get('EVOBEAT_SHARD_COUNT', self.config_data.get('shard_count', 1)))
+        except ValueError:
+            sys.exit('ERROR: EVOBEAT_SHARD_COUNT must be a positive integer.')
+        if self.shard_count < 1:
+            sys.exit('ERROR: EVOBEAT_SHARD_COUNT must be a positive integer.')
+        self.shard_index = 0
+        if self.shard_count > 1:
+            shard_index = os.environ.get('EVOBEAT_SHARD_INDEX')
+            if shard_index is None:
+                ordinal = re.search(r'-(\d+)$', socket.gethostname())
+                if not ordinal:
+                    sys.exit('ERROR: EVOBEAT_SHARD_INDEX not set and hostname has no StatefulSet ordinal.')
+                shard_index = ordinal.group(1)
+            try:
+                self.shard_index = int(shard_index)
+            except ValueError:
+                sys.exit('ERROR: EVOBEAT_SHARD_INDEX must be an integer.')
+            if not 0 <= self.shard_index < self.shard_count:
+                sys.exit(f'ERROR: Shard index {self.shard_index} not in range 0 - {self.shard_count - 1}.')
+            inventory = self.config_data.get('inventory')
+            self.config_data['inventory'] = shard_inventory(inventory, self.shard_index, self.shard_count)
+            msg = f'Shard {self.shard_index} of {self.shard_count}: collecting ' + \
+                  f'{len(self.config_data["inventory"] or [])} of {len(inventory or [])} inventory items.'
+            self.logger.info(msg)
+        # Open the spool
+        if spool:
+            try:
+                self.spool = DiskSpool(spool_dir, self.logger, segment_bytes=spool_segment_bytes,
+                                       max_bytes=spool_max_bytes)
+            except Exception as error:
+                sys.exit(f'ERROR: Failed to open spool {spool_dir}: {str(error)}.')
+        else:
+            self.spool = None
+        self.spool_replayer = None
         # Set base parameters
         self.started = False
+        self.batch_queue = None
+        self.batch_poster = None
+        # Thread pool POSTing chunks, shared by the beats of a Supervisor.
+        self.bulk_executor = None
+        self.batch_slots = threading.Semaphore(self.post_queue_size)
+        self.post_lock = threading.Lock()
+        # Document counts since start, and the most recent permanently rejected documents.
+        self.post_stats = {'success': 0, 'failed': 0, 'retried': 0, 'rejected': 0}
+        self.rejected_docs = collections.deque(maxlen=100)
+        self.overruns = 0
         # Declare vault client and secrets
         self.vault_client = None
         self.vault_secrets = None
@@ -133,22 +805,29 @@ class basebeat(object):
         self.config_data['collector_secrets'] = None
         # Get secrets from Vault
         #self.get_vault_credentials()
-        # Create elastic session
-        self.es = Elasticsearch(
-                        self.elastic_host,
-                        http_auth=(self.elastic_username,self.elastic_password),
-                        port=self.elastic_port,
-                        scheme=self.elastic_scheme,
-                        verify_certs=False,
-                        connection_class=RequestsHttpConnection,
-                        request_timeout=10
-                            )
+        # Create elastic session, shared with other beats in this process using the same connection
+        elastic_client_key = repr((self.elastic_host, self.elastic_port, self.elastic_scheme,
+                                   self.elastic_username, self.elastic_password))
+        with elastic_clients_lock:
+            if elastic_client_key not in elastic_clients:
+                elastic_clients[elastic_client_key] = Elasticsearch(
+                                self.elastic_host,
+                                http_auth=(self.elastic_username,self.elastic_password),
+                                port=self.elastic_port,
+                                scheme=self.elastic_scheme,
+                                verify_certs=False,
+                                connection_class=RequestsHttpConnection,
+                                request_timeout=10
+                                    )
+            self.es = elastic_clients[elastic_client_key]
         # Test connection to elastic
         self.logger.info(f'Testing connection to elasticsearch ...')      
         self.logger.info(f'host:{self.elastic_host} port:{self.elastic_port} scheme:{self.elastic_scheme}.')
         if not self.es.ping(request_timeout=1):
             if self.mode == "test":
                 self.logger.warning('Connection to elasticsearch failed.')
+            elif self.spool:
+                self.logger.warning('Connection to elasticsearch failed, documents will be spooled.')
             else:
                 self.logger.error('Connection to elasticsearch failed.')
                 sys.exit()
@@ -163,8 +842,15 @@ class basebeat(object):
         except:
             pass
 
-    def post(self):
+    def post(self, docs=None, post_time=None):
         f_name = sys._getframe().f_code.co_name
+        # docs defaults to self.elastic_docs, post_time defaults to now.
+        if docs is None:
+            docs = self.elastic_docs
+            # Empty list of collected docs
+            self.elastic_docs = []
+        if post_time is None:
+            post_time = time.time()
         # "mode" is either "run" or "test"
         if self.mode == "test":
             msg = f'WARNING: {f_name}: POST not allowed in test mode.'
@@ -177,82 +863,625 @@ class basebeat(object):
         else:
             msg = f'{f_name}: Invalid index_rotate value {self.elastic_index_rotate}'
             return {'rc': 1}
-        es_index = self.elastic_index + '-' + datetime.datetime.now().strftime(index_suffix)
-        doc_header = {
-                    "_index": es_index,
-                    "_op_type": "create"
-                    }
-        if time.localtime().tm_isdst:
-            offset = time.altzone / 3600
-        else:
-            offset = time.timezone / 3600
-        utc_dt = datetime.datetime.now() + datetime.timedelta(hours=offset)
-        for doc in self.elastic_docs:
-            # Add doc header to each doc.
-            doc.update(doc_header)
-            # Add @timestamp field if not already set.
-            if '@timestamp' not in doc:
-                doc['@timestamp'] = utc_dt.isoformat()
+        # Documents from process pool workers are already serialized with their envelope.
+        serialized = isinstance(docs, SerializedDocs)
+        es_index = self.elastic_index + '-' + datetime.datetime.fromtimestamp(post_time).strftime(index_suffix)
+        # Bulk action shared by every document in the batch.
+        action = {"create": {"_index": es_index}}
+        # @timestamp (if not already set) and static fields are added as each document is serialized.
+        envelope = Envelope(self.envelope_fields(post_time), default=self.es.transport.serializer.default)
+
+        def actions():
+            if serialized:
+                for data in docs.lines():
+                    yield action, data
+                return
+            for doc in docs:
+                # Serialize once here, the elastic serializer passes strings through unchanged.
+                yield action, envelope.dumps(doc)
+
         # POST to elastic.
         if self.debug:
             msg = f'{f_name}: POSTing to index {es_index}'
             self.logger.debug(msg)
-        retry = 2
-        while retry:
+        # A generator is collected while it is POSTed. If another batch holds post_lock, the
+        # generator is collected into a list first, so the collection is not held up by the lock
+        # and concurrent collections (e.g. staggered slots) are not run one after another.
+        if isinstance(docs, (list, SerializedDocs)):
+            self.post_lock.acquire()
+        elif not self.post_lock.acquire(blocking=False):
+            collected_docs = []
             try:
-                bulk_results = helpers.bulk(self.es, self.elastic_docs)
-                msg = f'{f_name}: {bulk_results[0]} documents POSTed successfully.'
-                self.logger.info(msg)
-                rc = 0
-                retry = 0
+                for doc in docs:
+                    collected_docs.append(doc)
             except Exception as error:
+                # POST what was collected, as when the generator fails while it is POSTed.
                 self.logger.error(str(error))
-                rc = 1
-                retry -= 1
-                if retry:
-                    time.sleep(2)
-                    msg = f'{f_name}: POST failed, retrying.'
+            docs = collected_docs
+            self.post_lock.acquire()
+        try:
+            if self.change_cache and not serialized:
+                # Drop documents that are unchanged since they were last POSTed. The cycle is
+                # started under post_lock, so batches POSTed concurrently do not share it.
+                self.change_cache.start_cycle(post_time)
+                docs = self.change_cache.filter(docs)
+            try:
+                if self.spool and not self.es.ping(request_timeout=1):
+                    # elasticsearch is unreachable, spool the batch to be replayed later.
+                    spooled = 0
+                    for chunk in self.chunk_actions(actions()):
+                        self.spool.append(chunk)
+                        spooled += len(chunk)
+                        if self.change_cache and not serialized:
+                            self.change_cache.forget(json.loads(data) for action, data in chunk)
+                    msg = f'{f_name}: Connection to elasticsearch failed, {spooled} documents spooled.'
+                    self.logger.warning(msg)
+                    rc = 1
+                else:
+                    results = self.post_chunks(self.chunk_actions(actions()))
+                    msg = f'{f_name}: {results["success"]} documents POSTed successfully ' + \
+                          f'in {results["chunks"]} chunks, {results["retried"]} retries.'
                     self.logger.info(msg)
-        # Empty list of collected docs
-        self.elastic_docs = []
+                    if results['failed'] or results['rejected']:
+                        msg = f'{f_name}: {results["failed"]} documents failed after retries ' + \
+                              f'({results["spooled"]} spooled), {results["rejected"]} rejected, ' + \
+                              f'{results["failed_chunks"]} chunks failed.'
+                        self.logger.error(msg)
+                    msg = f'{f_name}: Totals since start: {self.post_stats["success"]} POSTed, ' + \
+                          f'{self.post_stats["retried"]} retries, {self.post_stats["failed"]} failed, ' + \
+                          f'{self.post_stats["rejected"]} rejected.'
+                    self.logger.info(msg)
+                    rc = 1 if results['failed'] or results['rejected'] else 0
+                    # Rejected documents are not retried, so they stay in the cache like POSTed ones.
+                    if self.change_cache and not serialized:
+                        self.change_cache.forget(json.loads(data) for action, data in results['failed_pairs'])
+            except Exception as error:
+                self.logger.error(str(error))
+                rc = 1
+                # Which documents were POSTed is unknown, forget them all.
+                if self.change_cache:
+                    self.change_cache.clear()
+            if self.spool:
+                backlog, segments = self.spool.depth()
+                msg = f'{f_name}: Spool backlog {backlog} bytes in {segments} segments.'
+                self.logger.info(msg)
+            if self.change_cache and not serialized:
+                msg = f'{f_name}: Change cache {"snapshot" if self.change_cache.snapshot else "skipped"} ' + \
+                      f'{self.change_cache.hits} unchanged documents, {self.change_cache.misses} changed, ' + \
+                      f'{len(self.change_cache.hashes)} cached, {self.change_cache.evictions} evicted.'
+                self.logger.info(msg)
+                if self.change_cache.duplicates:
+                    msg = f'{f_name}: {self.change_cache.duplicates} documents repeat a change cache key ' + \
+                          f'of the batch (e.g. {self.change_cache.duplicate_key}), change_cache_fields ' + \
+                          f'do not identify documents.'
+                    self.logger.warning(msg)
+        finally:
+            self.post_lock.release()
         return {'rc': rc}
 
+    def envelope_fields(self, post_time):
+        # Fields added to every document in the batch for post_time. Documents are stamped
+        # with the logical post time, not the time the POST happens.
+        envelope_fields = dict(self.static_fields)
+        envelope_fields['@timestamp'] = datetime.datetime.utcfromtimestamp(post_time).isoformat()
+        return envelope_fields
+
+    def enveloped_docs(self, docs, post_time=None):
+        # Documents as they would be indexed, with the envelope fields. Used by test mode.
+        if post_time is None:
+            post_time = time.time()
+        envelope = Envelope(self.envelope_fields(post_time), default=JSONSerializer().default)
+        return [json.loads(envelope.dumps(doc)) for doc in docs]
+
+    def ops_due(self, post_time, slot=0):
+        # Scheduled operations due at post_time: on multiples of their interval, on the first
+        # cycle, or when their last successful run is an interval or more ago (e.g. after an
+        # overrun or a failed collection).
+        ops_last = self.ops_last.get(slot, {})
+        ops_due = []
+        for op, op_interval in self.op_intervals.items():
+            last_time = ops_last.get(op)
+            if last_time is None or int(round(post_time)) % op_interval == 0 or post_time - last_time >= op_interval:
+                ops_due.append(op)
+        return ops_due
+
+    def work_units(self, config_data):
+        # Split the collection into configurations for process pool workers. Collector modules
+        # can provide work_units(config_data), otherwise a dictionary inventory is split by key
+        # and a list inventory into one part per worker, by worker_lane() of each item.
+        if hasattr(self.collector_module, 'work_units'):
+            return self.collector_module.work_units(config_data)
+        inventory = config_data.get('inventory')
+        if isinstance(inventory, dict):
+            parts = [{key: value} for key, value in inventory.items()]
+        elif isinstance(inventory, list) and inventory:
+            lanes = {}
+            for item in inventory:
+                lanes.setdefault(worker_lane(inventory_key(item), self.process_workers), []).append(item)
+            parts = [lanes[lane] for lane in sorted(lanes)]
+        else:
+            parts = [inventory]
+        work_units = []
+        for part in parts:
+            work_unit = dict(config_data)
+            work_unit['inventory'] = part
+            work_units.append(work_unit)
+        return work_units
+
+    def process_pool(self, slot, lane):
+        # Each worker lane is a pool of one process, so a work unit always runs in the same
+        # process. Workers are started by a fork server, so they do not inherit this process's
+        # threads, held locks or log handlers.
+        with self.process_lock:
+            if (slot, lane) not in self.process_pools:
+                context = multiprocessing.get_context('forkserver')
+                if sys.version_info >= (3, 7):
+                    process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context)
+                else:
+                    # ProcessPoolExecutor has no mp_context before Python 3.7.
+                    multiprocessing.set_start_method('forkserver', force=True)
+                    process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+                self.process_pools[(slot, lane)] = process_pool
+            return self.process_pools[(slot, lane)]
+
+    def start_worker_logging(self):
+        # Workers log to a queue read by log_listener, which hands their records to this beat's
+        # handlers. A manager queue can be passed with each work unit, unlike a multiprocessing queue.
+        with self.process_lock:
+            if self.log_queue is not None:
+                return
+            self.log_manager = multiprocessing.get_context('forkserver').Manager()
+            self.log_queue = self.log_manager.Queue()
+            self.log_listener = QueueListener(self.log_queue, *self.logger.handlers, respect_handler_level=True)
+            self.log_listener.start()
+            # Stop the listener before the manager is shut down at exit.
+            atexit.register(self.log_listener.stop)
+
+    def abandon_process_pool(self, slot, lane):
+        # Stop a lane with a hung or dead worker, a new worker is started next cycle. Only the
+        # slot's own workers are stopped.
+        with self.process_lock:
+            process_pool = self.process_pools.pop((slot, lane), None)
+        if process_pool is None:
+            return
+        processes = list((getattr(process_pool, '_processes', None) or {}).values())
+        process_pool.shutdown(wait=False)
+        for process in processes:
+            process.terminate()
+
+    def collect_processes(self, post_time, config_data, slot=0):
+        f_name = sys._getframe().f_code.co_name
+        self.start_worker_logging()
+        work_units = self.work_units(config_data)
+        envelope_fields = self.envelope_fields(post_time)
+        futures = []
+        for work_unit in work_units:
+            lane = work_unit_lane(work_unit, self.process_workers)
+            submit_args = (collect_work_unit, self.collector_module_path, work_unit, envelope_fields,
+                           self.log_queue, self.logger.name, self.logger.level)
+            try:
+                future = self.process_pool(slot, lane).submit(*submit_args)
+            except concurrent.futures.process.BrokenProcessPool:
+                # The lane's worker died, start a new one.
+                self.abandon_process_pool(slot, lane)
+                future = self.process_pool(slot, lane).submit(*submit_args)
+            futures.append((lane, future))
+        # Work units still running after an interval are abandoned.
+        done, not_done = concurrent.futures.wait([future for lane, future in futures], timeout=self.interval)
+        blobs = []
+        restart_lanes = set()
+        for number, (lane, future) in enumerate(futures, 1):
+            if future in not_done:
+                future.cancel()
+                restart_lanes.add(lane)
+                msg = f'{f_name}: Work unit {number} timed out after {self.interval} seconds.'
+                self.logger.error(msg)
+                continue
+            try:
+                blob, ops_completed = future.result()
+                blobs.append(blob)
+                if 'ops_completed' in config_data:
+                    config_data['ops_completed'].extend(ops_completed)
+            except concurrent.futures.process.BrokenProcessPool:
+                restart_lanes.add(lane)
+                msg = f'{f_name}: Work unit {number} failed, a worker process terminated abruptly.'
+                self.logger.error(msg)
+            except Exception as error:
+                msg = f'{f_name}: Work unit {number} failed: {str(error)}'
+                self.logger.error(msg)
+        for lane in sorted(restart_lanes):
+            msg = f'{f_name}: Restarting worker process {lane} of slot {slot}.'
+            self.logger.warning(msg)
+            self.abandon_process_pool(slot, lane)
+        msg = f'{f_name}: {len(blobs)} of {len(work_units)} work units collected on {self.process_workers} processes.'
+        self.logger.info(msg)
+        return SerializedDocs(blobs)
+
+    def chunk_actions(self, actions):
+        # Group (action, data) pairs into chunks of at most elastic_chunk_size documents
+        # and elastic_max_chunk_bytes bytes, in the same way helpers.bulk would.
+        chunk = []
+        chunk_bytes = 0
+        action_bytes = {}
+        for action, data in actions:
+            if id(action) not in action_bytes:
+                action_bytes[id(action)] = len(json.dumps(action, separators=(',', ':'))) + 1
+            # data is ASCII JSON, so its length is its size in bytes.
+            pair_bytes = action_bytes[id(action)] + len(data) + 1
+            if chunk and (len(chunk) == self.elastic_chunk_size or
+                          chunk_bytes + pair_bytes > self.elastic_max_chunk_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append((action, data))
+            chunk_bytes += pair_bytes
+        if chunk:
+            yield chunk
+
+    def post_chunk(self, number, chunk):
+        f_name = sys._getframe().f_code.co_name
+        # POST one chunk as a single bulk request. Documents refused with 429, 5xx or a
+        # connection error are POSTed again with jittered exponential backoff, any other
+        # refusal is permanent and the document is set aside in self.rejected_docs.
+        result = {'rc': 0, 'success': 0, 'failed': 0, 'retried': 0, 'rejected': 0, 'failed_pairs': []}
+        attempt = 0
+        while chunk:
+            retry_pairs = []
+            try:
+                responses = list(helpers.streaming_bulk(self.es, chunk,
+                                                        chunk_size=len(chunk),
+                                                        max_chunk_bytes=self.elastic_max_chunk_bytes,
+                                                        raise_on_error=False,
+                                                        raise_on_exception=False,
+                                                        expand_action_callback=lambda pair: pair))
+            except Exception as error:
+                # Not a transport error, every document in the chunk can be retried.
+                self.logger.error(f'{f_name}: Chunk {number}: {str(error)}')
+                responses = [(False, {'create': {'status': 'N/A', 'error': str(error)}})] * len(chunk)
+            for pair, (ok, item) in zip(chunk, responses):
+                info = list(item.values())[0]
+                status = info.get('status')
+                if ok:
+                    result['success'] += 1
+                elif not isinstance(status, int) or status == 429 or status >= 500:
+                    retry_pairs.append(pair)
+                else:
+                    result['rejected'] += 1
+                    if result['rejected'] == 1:
+                        msg = f'{f_name}: Chunk {number} document rejected: {status} {info.get("error")}'
+                        self.logger.error(msg)
+                    self.rejected_docs.append({'status': status, 'error': info.get('error'), 'data': pair[1]})
+            if not retry_pairs:
+                break
+            attempt += 1
+            if attempt > self.elastic_max_retries:
+                result['failed'] += len(retry_pairs)
+                result['failed_pairs'] = retry_pairs
+                msg = f'{f_name}: Chunk {number}: {len(retry_pairs)} documents failed after ' + \
+                      f'{self.elastic_max_retries} retries.'
+                self.logger.error(msg)
+                break
+            result['retried'] += len(retry_pairs)
+            backoff = min(self.elastic_max_backoff, self.elastic_initial_backoff * 2 ** (attempt - 1))
+            backoff = backoff / 2 + random.uniform(0, backoff / 2)
+            msg = f'{f_name}: Chunk {number}: retrying {len(retry_pairs)} documents in {backoff:.2f} seconds ' + \
+                  f'(retry {attempt} of {self.elastic_max_retries}).'
+            self.logger.info(msg)
+            time.sleep(backoff)
+            chunk = retry_pairs
+        if result['failed'] or result['rejected']:
+            result['rc'] = 1
+        if self.debug or result['rc']:
+            msg = f'{f_name}: Chunk {number}: {result["success"]} documents POSTed, {result["retried"]} retried, ' + \
+                  f'{result["failed"]} failed, {result["rejected"]} rejected.'
+            self.logger.info(msg)
+        return result
+
+    def post_chunks(self, chunks):
+        # POST chunks on elastic_bulk_threads threads. Only one chunk per thread is queued
+        # at once so a streamed batch is never held in memory all at once.
+        results = {'success': 0, 'failed': 0, 'retried': 0, 'rejected': 0, 'spooled': 0,
+                   'chunks': 0, 'failed_chunks': 0, 'failed_pairs': []}
+
+        def tally(futures):
+            for future in futures:
+                result = future.result()
+                for counter in ['success', 'failed', 'retried', 'rejected']:
+                    results[counter] += result[counter]
+                    self.post_stats[counter] += result[counter]
+                results['chunks'] += 1
+                results['failed_pairs'].extend(result['failed_pairs'])
+                # Documents that still failed after retries are kept in the spool, if enabled.
+                if self.spool and result['failed_pairs']:
+                    self.spool.append(result['failed_pairs'])
+                    results['spooled'] += len(result['failed_pairs'])
+                if result['rc']:
+                    results['failed_chunks'] += 1
+
+        if self.bulk_executor is None:
+            self.bulk_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.elastic_bulk_threads,
+                                                                       thread_name_prefix=f'{self.name}-bulk')
+        # In a shared pool a beat with slow POSTs never holds more than its own threads.
+        pending = set()
+        for number, chunk in enumerate(chunks, 1):
+            pending.add(self.bulk_executor.submit(self.post_chunk, number, chunk))
+            if len(pending) >= self.elastic_bulk_threads:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                tally(done)
+        done, pending = concurrent.futures.wait(pending)
+        tally(done)
+        return results
+
+    def cycle_config(self, post_time, slot=0):
+        f_name = sys._getframe().f_code.co_name
+        # Collector configuration for the cycle POSTed at post_time.
+        if not self.op_intervals:
+            return self.config_data
+        # Tell the collector which scheduled operations are not due this cycle. Collectors that
+        # set reports_ops_completed add the operations they complete to ops_completed, see
+        # ops_collected().
+        ops_due = self.ops_due(post_time, slot)
+        config_data = dict(self.config_data)
+        config_data['ops_skipped'] = [op for op in self.op_intervals if op not in ops_due]
+        config_data['ops_completed'] = []
+        msg = f'{f_name}: Operations due {ops_due}, skipped {config_data["ops_skipped"]}.'
+        self.logger.info(msg)
+        return config_data
+
+    def record_ops(self, post_time, config_data, slot=0):
+        # Record the operations completed in config_data as run at post_time.
+        if getattr(self.collector_module, 'reports_ops_completed', False):
+            ops_completed = config_data['ops_completed']
+        else:
+            ops_completed = [op for op in self.op_intervals if op not in config_data['ops_skipped']]
+        ops_last = self.ops_last.setdefault(slot, {})
+        for op in self.op_intervals:
+            if op in ops_completed:
+                ops_last[op] = post_time
+
+    def ops_collected(self, docs, post_time, config_data, slot=0):
+        # Operations are recorded as run only once completed, so an operation that failed is
+        # retried on the next cycle. Collectors with reports_ops_completed list the operations
+        # they completed, for other collectors every operation due counts as completed when
+        # documents were returned.
+        if not self.op_intervals:
+            return docs
+        reports_ops_completed = getattr(self.collector_module, 'reports_ops_completed', False)
+        if isinstance(docs, SerializedDocs):
+            if reports_ops_completed or any(docs.blobs):
+                self.record_ops(post_time, config_data, slot)
+            return docs
+        if isinstance(docs, list):
+            if reports_ops_completed or docs:
+                self.record_ops(post_time, config_data, slot)
+            return docs
+        return self.ops_generated(docs, post_time, config_data, slot)
+
+    def ops_generated(self, docs, post_time, config_data, slot):
+        # Generators list their completed operations as they go, recorded when the generator
+        # is done. Otherwise the operations are recorded with the first document.
+        if getattr(self.collector_module, 'reports_ops_completed', False):
+            try:
+                yield from docs
+            finally:
+                self.record_ops(post_time, config_data, slot)
+            return
+        first = True
+        for doc in docs:
+            if first:
+                self.record_ops(post_time, config_data, slot)
+                first = False
+            yield doc
+
+    def collect_docs(self, post_time, config_data, slot=0):
+        f_name = sys._getframe().f_code.co_name
+        # Run the collector module, collect_data() function.
+        try:
+            if self.process_workers:
+                return self.collect_processes(post_time, config_data, slot)
+            return self.collector_module.collect_data(config_data)
+        except Exception:
+            msg = f'{f_name}: collect_data() failed.\n{traceback.format_exc()}'
+            self.logger.error(msg)
+            return []
+
+    def collect_slot(self, post_time, slot, config_data):
+        f_name = sys._getframe().f_code.co_name
+        # Collect and POST one staggered slot, stamped with the interval's POST time.
+        start_collect_time = time.time()
+        docs = self.collect_docs(post_time, config_data, slot)
+        docs = self.ops_collected(docs, post_time, config_data, slot)
+        self.post(docs, post_time=post_time)
+        msg = f'{f_name}: Time to collect and POST slot {slot}: {time.time() - start_collect_time:.2f}.'
+        self.logger.info(msg)
+
+    def collect(self, post_time):
+        f_name = sys._getframe().f_code.co_name
+        start_collect_time = time.time()
+        config_data = self.cycle_config(post_time)
+        docs = self.ops_collected(self.collect_docs(post_time, config_data), post_time, config_data)
+        if not isinstance(docs, (list, SerializedDocs)):
+            # Generators are POSTed while they are being collected, stamped with post_time.
+            self.post(docs, post_time=post_time)
+            time_now = time.time()
+            self.collect_duration.add(time_now - start_collect_time)
+            msg = f'{f_name}: Time to collect and POST data: {time_now - start_collect_time:.2f}.'
+            self.logger.info(msg)
+            return
+        time_now = time.time()
+        self.collect_duration.add(time_now - start_collect_time)
+        msg = f'{f_name}: Time to collect data: {time_now - start_collect_time:.2f}.'
+        self.logger.info(msg)
+        if time_now > post_time:
+            msg = f'{f_name}: Collection for {datetime.datetime.fromtimestamp(post_time)} ' + \
+                  f'finished {time_now - post_time:.2f} seconds after its POST time.'
+            self.logger.warning(msg)
+        # Blocks while all batch slots are in use, which is reported as an overrun by run().
+        self.batch_slots.acquire()
+        self.batch_queue.put((self, post_time, docs))
+
     def run(self):
         f_name = sys._getframe().f_code.co_name
         # POST when time is a multiple of interval.
-        # Collect data ahead of the POST time (processing_time)
+        # Collect data ahead of the POST time, by the estimated collection time (processing_time)
         self.started = True
-        processing_time = 5
-        # wait_time = self.interval - processing_time
-        # Calculate seconds to wait to run first collection
+        if self.stagger_slots > 1:
+            return self.run_staggered()
+        processing_time = min(self.collect_duration.estimate(), self.interval)
+        # Collected batches are POSTed by a separate thread, so the next collection can
+        # start while the previous batch is still being POSTed.
+        if self.batch_poster is None:
+            self.batch_queue = queue.Queue()
+            self.batch_poster = BatchPoster(self.batch_queue, name=f'{self.name}-poster')
+            self.batch_poster.start()
+        # Spooled documents are replayed in the background.
+        if self.spool and self.spool_replayer is None:
+            self.spool_replayer = SpoolReplayer(self)
+            self.spool_replayer.start()
+        collector = None
+        # Calculate first POST time
         time_now = time.time()
-        seconds_until_post = self.interval - (time_now % self.interval)
-        seconds_until_collect = seconds_until_post - processing_time
-        post_time = time_now + seconds_until_post
-        collect_time = datetime.datetime.fromtimestamp(time_now + seconds_until_collect)
+        post_time = time_now + self.interval - (time_now % self.interval)
+        collect_time = datetime.datetime.fromtimestamp(post_time - processing_time)
         msg = f'{f_name}: Starting at {collect_time}.'
         self.logger.info(msg)
-        # Wait for first collection.
-        if seconds_until_collect > 0:
-            time.sleep(seconds_until_collect)
         while True:
-            start_collect_time = time.time()
-            # Run the collector module, collect_data() function.
-            self.elastic_docs = self.collector_module.collect_data(self.config_data)
-            actual_processing_time = time.time() - start_collect_time
             time_now = time.time()
-            seconds_until_post = post_time - time_now
-            if seconds_until_post > 0:
-                time.sleep(seconds_until_post)
-            self.post()
-            # Calculate next collect time.
-            time_now = int(time.time())
-            seconds_until_post = self.interval - (time_now % self.interval)
-            seconds_until_collect = seconds_until_post - processing_time
-            post_time = time_now + seconds_until_post
+            if time_now > post_time:
+                # The scheduler itself fell behind (e.g. the host was suspended), realign.
+                msg = f'{f_name}: Missed POST time {datetime.datetime.fromtimestamp(post_time)}, realigning.'
+                self.logger.warning(msg)
+                post_time = time_now + self.interval - (time_now % self.interval)
+                continue
+            # Start collecting just early enough to finish by the POST time.
+            processing_time = min(self.collect_duration.estimate(), self.interval)
+            msg = f'{f_name}: Collection lead {processing_time:.2f} seconds ' + \
+                  f'(average {self.collect_duration.ewma or 0:.2f}, p95 {self.collect_duration.p95() or 0:.2f}).'
+            self.logger.info(msg)
+            seconds_until_collect = post_time - processing_time - time_now
             if seconds_until_collect > 0:
-                minutes_to_sleep, seconds_to_sleep = divmod((seconds_until_collect), 60)
-                msg = f'{f_name}: Time to collect data: {actual_processing_time:.2f}, ' + \
-                      f'sleeping for {minutes_to_sleep} minutes {seconds_to_sleep} seconds.'
+                minutes_to_sleep, seconds_to_sleep = divmod(int(seconds_until_collect), 60)
+                msg = f'{f_name}: Sleeping for {minutes_to_sleep} minutes {seconds_to_sleep} seconds.'
                 self.logger.info(msg)
                 time.sleep(seconds_until_collect)
+            if collector and collector.is_alive():
+                # Previous collection (or its hand-off to a full POST queue) is still running.
+                self.overruns += 1
+                msg = f'{f_name}: Overrun {self.overruns}, previous collection still running, ' + \
+                      f'skipping collection for {datetime.datetime.fromtimestamp(post_time)}.'
+                self.logger.warning(msg)
+            else:
+                collector = threading.Thread(target=self.collect, args=(post_time,),
+                                             name=f'{self.name}-collect', daemon=True)
+                collector.start()
+            post_time += self.interval
+
+    def run_staggered(self):
+        f_name = sys._getframe().f_code.co_name
+        # Poll the inventory in stagger_slots slots spread evenly over the interval, each
+        # inventory item in the slot given by a hash of its key. Every slot is POSTed as soon
+        # as it is collected, stamped with the interval's POST time.
+        if self.spool and self.spool_replayer is None:
+            self.spool_replayer = SpoolReplayer(self)
+            self.spool_replayer.start()
+        slot_step = self.interval / self.stagger_slots
+        collectors = {}
+        time_now = time.time()
+        post_time = time_now + self.interval - (time_now % self.interval)
+        msg = f'{f_name}: Starting at {datetime.datetime.fromtimestamp(post_time)}, ' + \
+              f'{self.stagger_slots} slots {slot_step:.2f} seconds apart.'
+        self.logger.info(msg)
+        while True:
+            time_now = time.time()
+            if time_now > post_time + slot_step:
+                # The scheduler itself fell behind (e.g. the host was suspended), realign.
+                msg = f'{f_name}: Missed POST time {datetime.datetime.fromtimestamp(post_time)}, realigning.'
+                self.logger.warning(msg)
+                post_time = time_now + self.interval - (time_now % self.interval)
+                continue
+            for slot in range(self.stagger_slots):
+                seconds_until_slot = post_time + slot * slot_step - time.time()
+                if seconds_until_slot > 0:
+                    time.sleep(seconds_until_slot)
+                # Operations due are worked out per slot, so a failed slot retries its own operations.
+                slot_config = dict(self.cycle_config(post_time, slot))
+                slot_config['inventory'] = slot_inventory(self.config_data.get('inventory'), slot, self.stagger_slots)
+                if not slot_config['inventory']:
+                    continue
+                collector = collectors.get(slot)
+                if collector and collector.is_alive():
+                    # Previous collection of this slot is still running.
+                    self.overruns += 1
+                    msg = f'{f_name}: Overrun {self.overruns}, slot {slot} still running, ' + \
+                          f'skipping slot {slot} for {datetime.datetime.fromtimestamp(post_time)}.'
+                    self.logger.warning(msg)
+                    continue
+                msg = f'{f_name}: Collecting slot {slot}, {len(slot_config["inventory"])} inventory items.'
+                self.logger.info(msg)
+                collectors[slot] = threading.Thread(target=self.collect_slot, args=(post_time, slot, slot_config),
+                                                    name=f'{self.name}-collect-{slot}', daemon=True)
+                collectors[slot].start()
+            post_time += self.interval
+
+
+class Supervisor(object):
+    """ Runs several collectors in one process, each on its own interval.
+
+    The beats share elasticsearch clients (one per connection) and the thread pool that
+    POSTs chunks. Each beat is scheduled in its own thread and has its own batch queue and
+    POST thread, so a failure, overrun or slow POST in one collector does not hold up the
+    others.
+    """
+
+    def __init__(self, configs, mode='run', debug=False):
+        # configs is a list of (name, yaml) tuples, yaml is None for configs/{name}.yaml
+        self.beats = []
+        for name, yaml_file in configs:
+            try:
+                beat = basebeat(name=name, mode=mode, yaml=yaml_file)
+            except SystemExit as error:
+                # A configuration error only stops that collector.
+                print(str(error) or f'ERROR: {name}: Failed to start.')
+                continue
+            except Exception as error:
+                print(f'ERROR: {name}: {str(error)}')
+                continue
+            if debug:
+                beat.debug = True
+                beat.config_data['debug'] = None
+            self.beats.append(beat)
+        if not self.beats:
+            sys.exit('ERROR: No collectors started.')
+        # Batch queues and POST threads are started by each beat's run(). The chunk thread
+        # pool has each beat's elastic_bulk_threads, a beat never uses more than its own.
+        self.bulk_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=sum(beat.elastic_bulk_threads for beat in self.beats), thread_name_prefix='bulk')
+        for beat in self.beats:
+            beat.bulk_executor = self.bulk_executor
+
+    def run_beat(self, beat):
+        # Restart a beat whose scheduler fails, without affecting the others.
+        while True:
+            try:
+                beat.run()
+            except Exception:
+                msg = f'run: Failed, restarting in {beat.interval} seconds.\n{traceback.format_exc()}'
+                beat.logger.error(msg)
+                time.sleep(beat.interval)
+
+    def run(self):
+        threads = []
+        for beat in self.beats:
+            thread = threading.Thread(target=self.run_beat, args=(beat,), name=f'{beat.name}-run', daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def run_once(self):
+        # Collect data and POST once for each beat.
+        for beat in self.beats:
+            try:
+                beat.post(beat.collector_module.collect_data(beat.config_data))
+            except Exception:
+                beat.logger.error(traceback.format_exc())